@@ -0,0 +1,12 @@
+"""Performance benchmarks of menu_maker, run as modules, e.g.
+
+    python -m benchmarks.annotate
+"""
+import os
+
+import django
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "uptrader_task.settings")
+    django.setup()
@@ -0,0 +1,42 @@
+"""Annotation and rendering of large in-memory menus.
+
+    python -m benchmarks.annotate [size ...]
+"""
+import sys
+import timeit
+from typing import List
+
+from benchmarks import setup
+
+setup()
+
+from benchmarks.generator import make_rows  # noqa: E402
+from menu_maker.templatetags.draw_menu import (  # noqa: E402
+    _annotate_nodes,
+    _build_fragment,
+)
+
+DEFAULT_SIZES = [10_000, 50_000, 100_000]
+
+
+def best_of(func, repeat: int = 5) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(sizes: List[int]):
+    print(f"{'items':>8} {'annotate':>10} {'build':>10} {'render':>10}")
+    for size in sizes:
+        rows = make_rows(size)
+        active = rows[-1].slug
+        annotate = best_of(lambda: _annotate_nodes(rows, active))
+        build = best_of(lambda: _build_fragment("Clothing", rows), repeat=1)
+        fragment = _build_fragment("Clothing", rows)
+        render = best_of(lambda: fragment.render(active), repeat=20)
+        print(
+            f"{size:>8} {annotate * 1000:>8.1f}ms {build * 1000:>8.1f}ms"
+            f" {render * 1000:>8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,94 @@
+"""Synthetic menu trees of configurable shape for benchmarks."""
+import random
+from typing import List, Optional
+
+from menu_maker.cache import TreeRow
+from menu_maker.models import MenuItem
+
+
+def make_rows(
+    size: int,
+    fanout: int = 10,
+    depth: Optional[int] = None,
+    skew: float = 0.0,
+    seed: int = 0,
+) -> List[TreeRow]:
+    """returns lft-ordered rows of a single tree of size nodes, named "Item {k}"
+    with root "Item 0"
+
+    Nodes are attached breadth first, each parent getting fanout children, so
+    node k is child of (k - 1) // fanout by default. Nodes at depth levels below
+    root get no children, then parents above them are filled again in turns.
+    With skew, that share of nodes is attached to random parents biased
+    towards the first ones, so that leftmost subtrees grow much bigger than
+    others and fanout of their nodes is uneven.
+
+    Args:
+        size (int): number of nodes, including root
+        fanout (int): children of each parent in breadth first order
+        depth (Optional[int]): maximal depth of nodes, unlimited by default
+        skew (float): share of nodes placed off balance, from 0 to 1
+        seed (int): seed of random placement, so that trees are repeatable
+    """
+    rng = random.Random(seed)
+    children = [[] for _ in range(size)]
+    depths = [0] * size
+    # nodes which may get children, in creation order
+    parents = [0]
+    current = 0
+    taken = 0
+    for k in range(1, size):
+        if skew and rng.random() < skew:
+            parent = parents[int(len(parents) * rng.random() ** 4)]
+        else:
+            parent = parents[current]
+            taken += 1
+            if taken == fanout:
+                current = (current + 1) % len(parents)
+                taken = 0
+        children[parent].append(k)
+        depths[k] = depths[parent] + 1
+        if depth is None or depths[k] < depth:
+            parents.append(k)
+
+    rows = [None] * size
+    order = []
+    counter = 0
+    stack = [(0, None, False)]
+    while stack:
+        k, parent_id, visited = stack.pop()
+        counter += 1
+        if visited:
+            rows[k] = rows[k]._replace(rgt=counter)
+            continue
+        rows[k] = TreeRow(k + 1, f"Item {k}", f"item-{k}", counter, 0, parent_id)
+        order.append(k)
+        stack.append((k, parent_id, True))
+        stack.extend((child, k + 1, False) for child in reversed(children[k]))
+    return [rows[k] for k in order]
+
+
+def load_rows(rows: List[TreeRow], tree_id: int = 1, batch_size: int = 5000):
+    """inserts generated tree with depth and path, bypassing MenuItem.save"""
+    items = []
+    # ancestors of current row as (rgt, path)
+    stack = []
+    for row in rows:
+        while stack and stack[-1][0] < row.lft:
+            stack.pop()
+        path = f"{stack[-1][1]}/{row.slug}" if stack else row.slug
+        items.append(
+            MenuItem(
+                id=row.id,
+                name=row.name,
+                slug=row.slug,
+                tree_id=tree_id,
+                lft=row.lft,
+                rgt=row.rgt,
+                parent_id=row.parent_id,
+                depth=len(stack),
+                path=path,
+            )
+        )
+        stack.append((row.rgt, path))
+    MenuItem.objects.bulk_create(items, batch_size=batch_size)
@@ -0,0 +1,94 @@
+"""Query plans and latency of nested set queries on large tables.
+
+    python -m benchmarks.queries [--drop-indexes] [size ...]
+
+Sizes are loaded one by one into a test database, which is destroyed afterwards.
+With --drop-indexes composite indexes of MenuItem are removed before measuring,
+to compare plans with and without them.
+"""
+import sys
+from typing import List
+
+from benchmarks import setup
+
+setup()
+
+from django.db import connection, transaction  # noqa: E402
+from django.test.utils import (  # noqa: E402
+    CaptureQueriesContext,
+    setup_test_environment,
+)
+from menu_maker.models import MenuItem  # noqa: E402
+from benchmarks.annotate import best_of  # noqa: E402
+from benchmarks.generator import load_rows, make_rows  # noqa: E402
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def drop_indexes():
+    with connection.schema_editor() as editor:
+        for index in MenuItem._meta.indexes:
+            editor.remove_index(MenuItem, index)
+
+
+def shift_update(node: MenuItem):
+    """inserts child into the middle of the table, shifting every row after it"""
+    with transaction.atomic():
+        MenuItem(name="New Item", lft=0, rgt=0, parent=node).save()
+        transaction.set_rollback(True)
+
+
+def measure(size: int):
+    load_rows(make_rows(size))
+    # node at depth 2, subtree of about 1% of the table
+    node = MenuItem.objects.filter(depth=2).order_by("lft")[5]
+
+    tree = MenuItem.objects.get_tree(node.id)
+    children = MenuItem.objects.get_descendants(node.id, direct_only=True)
+    shifted = MenuItem.objects.filter(tree_id=node.tree_id, rgt__gt=node.rgt)
+    plans = [
+        ("get_tree", tree.explain()),
+        ("get_descendants", children.explain()),
+        ("shift", shifted.explain()),
+    ]
+    with CaptureQueriesContext(connection) as context:
+        shift_update(node)
+    timings = [
+        ("get_tree", best_of(lambda: list(MenuItem.objects.get_tree(node.id)))),
+        (
+            "get_descendants",
+            best_of(
+                lambda: list(MenuItem.objects.get_descendants(node.id, True)),
+            ),
+        ),
+        ("shift", best_of(lambda: shift_update(node), repeat=3)),
+    ]
+
+    print(f"\n{size} items, {len(tree)} in subtree, {len(children)} children")
+    for name, plan in plans:
+        print(f"  {name} plan:")
+        for line in plan.splitlines():
+            print(f"    {line}")
+    print(f"  shift queries: {len(context)}")
+    for name, seconds in timings:
+        print(f"  {name:<16} {seconds * 1000:>10.2f}ms")
+
+
+def main(sizes: List[int], no_indexes: bool = False):
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        if no_indexes:
+            drop_indexes()
+        for size in sizes:
+            MenuItem.objects.all()._raw_delete(connection.alias)
+            measure(size)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    no_indexes = "--drop-indexes" in args
+    sizes = [int(arg) for arg in args if arg != "--drop-indexes"]
+    main(sizes or DEFAULT_SIZES, no_indexes)
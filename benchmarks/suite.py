@@ -0,0 +1,234 @@
+"""Timings and query counts of tree reads, renders and mutations on synthetic trees.
+
+    python -m benchmarks.suite [size ...] [--fanout N] [--depth N] [--skew S]
+        [--seed N] [--repeat N] [--output results.json]
+        [--compare old.json] [--threshold 1.25]
+
+Each size is loaded into a test database as a single generated tree, which is
+destroyed afterwards. Mutations run in transactions rolled back after each
+repeat, so that every run starts from the same tree. Results are written as
+json with --output, and with --compare they are checked against earlier
+results: benchmarks slower by threshold or running more queries are reported
+as regressions and the exit status is 1.
+"""
+import argparse
+import copy
+import json
+import platform
+import subprocess
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from benchmarks import setup
+
+setup()
+
+import django  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+from django.test.utils import (  # noqa: E402
+    CaptureQueriesContext,
+    setup_test_environment,
+)
+from menu_maker import cache  # noqa: E402
+from menu_maker.models import MenuItem  # noqa: E402
+from menu_maker.templatetags.draw_menu import (  # noqa: E402
+    get_expanded_fragment,
+    get_menu_fragment,
+)
+from benchmarks.annotate import best_of  # noqa: E402
+from benchmarks.generator import load_rows, make_rows  # noqa: E402
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+# menus are drawn with links to url named by menu
+ROOT = "Clothing"
+
+
+def rolled_back(func: Callable[[], Any]) -> Callable[[], None]:
+    def run():
+        with transaction.atomic():
+            func()
+            transaction.set_rollback(True)
+
+    return run
+
+
+def cold(func: Callable[[], Any]) -> Callable[[], None]:
+    """runs func after invalidating cached trees"""
+
+    def run():
+        cache.bump_tree_version()
+        func()
+
+    return run
+
+
+def make_benchmarks(rows) -> List[Tuple[str, Callable[[], Any]]]:
+    # node at depth 2 and depth 1 node in other branch, like menus edited by hand
+    node = MenuItem.objects.filter(depth=2).order_by("lft")[5]
+    target = MenuItem.objects.filter(depth=1).order_by("-lft")[0]
+    leaf = rows[-1]
+    root_children = list(
+        MenuItem.objects.filter(parent=rows[0].id)
+        .order_by("lft")
+        .values_list("id", flat=True)
+    )
+    leaves = [row.id for row in rows if row.rgt == row.lft + 1][::100][:50]
+
+    def move():
+        item = copy.copy(node)
+        item.parent = target
+        item.save()
+
+    return [
+        ("get_tree", lambda: list(MenuItem.objects.get_tree(ROOT))),
+        ("get_subtree", lambda: list(MenuItem.objects.get_tree(node.id))),
+        (
+            "get_children",
+            lambda: list(MenuItem.objects.get_descendants(node.id, True)),
+        ),
+        ("get_ancestors", lambda: list(MenuItem.objects.get_ancestors(leaf.id))),
+        ("render_cold", cold(lambda: get_menu_fragment(ROOT).render(leaf.slug))),
+        ("render_warm", lambda: get_menu_fragment(ROOT).render(leaf.slug)),
+        (
+            "render_depth_cold",
+            cold(lambda: get_expanded_fragment(ROOT, leaf.slug, 1).render(leaf.slug)),
+        ),
+        (
+            "insert_child",
+            rolled_back(lambda: MenuItem(name="New Item", parent=node).save()),
+        ),
+        ("insert_root", rolled_back(lambda: MenuItem(name="New Root").save())),
+        ("move_subtree", rolled_back(move)),
+        (
+            "reorder_children",
+            rolled_back(
+                lambda: MenuItem.objects.reorder_children(
+                    rows[0].id, root_children[::-1]
+                )
+            ),
+        ),
+        ("delete_subtree", rolled_back(lambda: copy.copy(node).delete())),
+        ("delete_leaves", rolled_back(lambda: MenuItem.objects.delete_nodes(leaves))),
+    ]
+
+
+def measure(rows, repeat: int) -> List[Dict[str, Any]]:
+    MenuItem.objects.all()._raw_delete(connection.alias)
+    load_rows(rows)
+    results = []
+    for name, func in make_benchmarks(rows):
+        with CaptureQueriesContext(connection) as context:
+            func()
+        # savepoints of atomic blocks are not queries of the benchmark
+        queries = [
+            query
+            for query in context.captured_queries
+            if "SAVEPOINT" not in query["sql"]
+        ]
+        results.append(
+            {
+                "size": len(rows),
+                "name": name,
+                "seconds": best_of(func, repeat=repeat),
+                "queries": len(queries),
+            }
+        )
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def compare(
+    results: List[Dict[str, Any]], old_results: List[Dict[str, Any]], threshold: float
+) -> List[str]:
+    """prints results next to old ones, returning descriptions of regressions"""
+    old = {(result["size"], result["name"]): result for result in old_results}
+    regressions = []
+    print(f"\n{'items':>8} {'benchmark':<18} {'time':>10} {'was':>10} {'queries':>10}")
+    for result in results:
+        previous = old.get((result["size"], result["name"]))
+        if previous is None:
+            continue
+        ratio = result["seconds"] / previous["seconds"] if previous["seconds"] else 1
+        mark = ""
+        if ratio > threshold or result["queries"] > previous["queries"]:
+            mark = " !"
+            regressions.append(f"{result['name']} on {result['size']} items")
+        print(
+            f"{result['size']:>8} {result['name']:<18}"
+            f" {result['seconds'] * 1000:>8.2f}ms {previous['seconds'] * 1000:>8.2f}ms"
+            f" {previous['queries']:>4} -> {result['queries']:<3}{mark}"
+        )
+    return regressions
+
+
+def main(args: argparse.Namespace) -> int:
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    results = []
+    try:
+        for size in args.sizes or DEFAULT_SIZES:
+            rows = make_rows(size, args.fanout, args.depth, args.skew, args.seed)
+            rows[0] = rows[0]._replace(name=ROOT, slug=ROOT.lower())
+            size_results = measure(rows, args.repeat)
+            print(f"\n{size} items")
+            for result in size_results:
+                print(
+                    f"  {result['name']:<18} {result['seconds'] * 1000:>10.2f}ms"
+                    f" {result['queries']:>4} queries"
+                )
+            results.extend(size_results)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.output:
+        report = {
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "options": {
+                "fanout": args.fanout,
+                "depth": args.depth,
+                "skew": args.skew,
+                "seed": args.seed,
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as stream:
+            json.dump(report, stream, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as stream:
+            old_results = json.load(stream)["results"]
+        regressions = compare(results, old_results, args.threshold)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sizes", nargs="*", type=int, help="numbers of items")
+    parser.add_argument("--fanout", type=int, default=10)
+    parser.add_argument("--depth", type=int, help="maximal depth of items")
+    parser.add_argument("--skew", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="json file to write results to")
+    parser.add_argument("--compare", help="json file of earlier results")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    sys.exit(main(parser.parse_args()))
@@ -10,6 +10,10 @@ class MenuAdmin(admin.ModelAdmin):
     exclude = ("lft", "rgt")
     form = MenuItemForm
 
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request).select_related("parent")
+        return MenuItem.objects.annotate_position(queryset)
+
     def child_position(self, obj: MenuItem):
         values = obj.get_position()
         if values:
@@ -17,8 +21,4 @@ class MenuAdmin(admin.ModelAdmin):
             return f"{position}/{total}"
 
     def delete_queryset(self, request, queryset):
-        queryset = queryset.order_by("lft")
-        for query in queryset:
-            persists = MenuItem.objects.filter(id=query.id).first()
-            if persists:
-                persists.delete()
+        MenuItem.objects.delete_nodes(queryset.values("id"))
@@ -1,6 +1,36 @@
+import logging
 from django.apps import AppConfig
+from django.db import DatabaseError
+from django.db.backends.signals import connection_created
+from menu_maker import conf
+
+logger = logging.getLogger(__name__)
+
+
+def _install_query_counter(sender, connection, **kwargs):
+    from menu_maker import instrumentation
+
+    if instrumentation.count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrumentation.count_query)
 
 
 class MenuMakerConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "menu_maker"
+
+    def ready(self):
+        # queries of menus are counted by instrumentation on every connection
+        connection_created.connect(_install_query_counter)
+        if conf.get("WARM_ON_STARTUP"):
+            self.warm_menus()
+
+    def warm_menus(self):
+        from menu_maker.templatetags.draw_menu import warm_menus
+
+        # tables are missing before first migrate
+        try:
+            names = warm_menus()
+        except DatabaseError as err:
+            logger.warning("Menus are not warmed up: %s", err)
+            return
+        logger.info("Warmed up menus: %s", ", ".join(names))
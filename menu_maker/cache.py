@@ -0,0 +1,243 @@
+"""Versioned menu tree cache.
+
+Every change of MenuItem bumps version of all trees, which all worker processes
+see as soon as the change is committed. With a cache backend shared by
+processes, such as memcached or redis, the version is kept in that cache and
+bumped after commit, so warm pages are served without database queries. With
+a process-local backend, such as local memory cache, it is kept in database and
+bumped in the same transaction, which costs one query per request.
+Cached trees and rendered menu fragments are keyed by that version, so outdated
+entries are never read and simply expire.
+"""
+import hashlib
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models import F, QuerySet, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from menu_maker import conf
+
+# tree version and unix time of its change in shared cache
+VERSION_KEY = "menu_maker:version"
+
+
+class TreeRow(NamedTuple):
+    """lightweight read-only copy of MenuItem used for menu rendering"""
+
+    id: int
+    name: str
+    slug: str
+    lft: int
+    rgt: int
+    parent_id: Optional[int]
+
+
+def get_cache():
+    return caches[conf.get("CACHE_ALIAS")]
+
+
+def is_process_local(backend: BaseCache) -> bool:
+    """checks if cache backend is not shared by processes, so that tree version
+    has to be kept in database"""
+    return isinstance(backend, (LocMemCache, DummyCache))
+
+
+# tree version and modification time read within version_scope, cleared by
+# tree changes
+_request_version: ContextVar[Optional[List[Tuple[int, int]]]] = ContextVar(
+    "menu_maker_tree_version", default=None
+)
+
+
+@contextmanager
+def version_scope() -> Iterator[None]:
+    """reads tree version at most once within the block, unless trees are
+    changed in it. Used for whole requests by menu_registry_middleware"""
+    if _request_version.get() is not None:
+        yield
+        return
+    # drops version of a change rolled back by earlier request
+    _get_uncommitted()
+    token = _request_version.set([])
+    try:
+        yield
+    finally:
+        _request_version.reset(token)
+
+
+def _tree_versions() -> QuerySet:
+    TreeVersion = apps.get_model("menu_maker", "TreeVersion")
+    return TreeVersion.objects.filter(id=1).values_list("version", "modified")
+
+
+def _create_tree_version() -> Tuple[int, datetime]:
+    TreeVersion = apps.get_model("menu_maker", "TreeVersion")
+    # start from current time, so lost row never repeats old versions
+    row, _ = TreeVersion.objects.get_or_create(
+        id=1, defaults={"version": time.time_ns(), "modified": timezone.now()}
+    )
+    return row.version, row.modified
+
+
+def _new_version() -> Tuple[int, int]:
+    # based on current time, so version lost by eviction is not repeated
+    return time.time_ns(), int(time.time())
+
+
+# negative version of trees changed by current transaction, until the change
+# is committed and shared version bumped, so that uncommitted rows read
+# meanwhile are neither cached nor read from cache under the shared version
+_uncommitted_version: ContextVar[Optional[Tuple[int, int]]] = ContextVar(
+    "menu_maker_uncommitted_version", default=None
+)
+
+
+def _get_uncommitted() -> Optional[Tuple[int, int]]:
+    version = _uncommitted_version.get()
+    if version is not None and not transaction.get_connection().in_atomic_block:
+        # transaction was rolled back, as commit resets it
+        _uncommitted_version.set(None)
+        return None
+    return version
+
+
+def _remember(version: Tuple[int, int]) -> Tuple[int, int]:
+    version = (version[0], version[1])
+    remembered = _request_version.get()
+    if remembered is not None:
+        remembered[:] = [version]
+    return version
+
+
+def _forget():
+    remembered = _request_version.get()
+    if remembered is not None:
+        remembered.clear()
+
+
+def _get_version() -> Tuple[int, int]:
+    remembered = _request_version.get()
+    if remembered:
+        return remembered[0]
+    backend = get_cache()
+    if is_process_local(backend):
+        row = _tree_versions().first() or _create_tree_version()
+        return _remember((row[0], int(row[1].timestamp())))
+    uncommitted = _get_uncommitted()
+    if uncommitted is not None:
+        return uncommitted
+    version = backend.get(VERSION_KEY)
+    if version is None:
+        version = _new_version()
+        backend.add(VERSION_KEY, version, None)
+        version = backend.get(VERSION_KEY, version)
+    return _remember(version)
+
+
+def get_tree_version() -> int:
+    """returns version of all trees, read once per request"""
+    return _get_version()[0]
+
+
+async def aget_tree_version() -> int:
+    remembered = _request_version.get()
+    if remembered:
+        return remembered[0][0]
+    backend = get_cache()
+    if is_process_local(backend):
+        row = await _tree_versions().afirst()
+        if row is None:
+            row = await sync_to_async(_create_tree_version)()
+        return _remember((row[0], int(row[1].timestamp())))[0]
+    uncommitted = _get_uncommitted()
+    if uncommitted is not None:
+        return uncommitted[0]
+    version = await backend.aget(VERSION_KEY)
+    if version is None:
+        version = _new_version()
+        await backend.aadd(VERSION_KEY, version, None)
+        version = await backend.aget(VERSION_KEY, version)
+    return _remember(version)[0]
+
+
+def _bump_shared_version():
+    backend = get_cache()
+    previous = backend.get(VERSION_KEY)
+    version, modified = _new_version()
+    if previous is not None:
+        version = max(version, previous[0] + 1)
+    backend.set(VERSION_KEY, (version, modified), None)
+    _uncommitted_version.set(None)
+    _forget()
+
+
+def bump_tree_version():
+    """changes tree version, so that other processes see new version together
+    with the changes. Version kept in shared cache is changed after commit,
+    version kept in database in current transaction. Version is the larger of
+    current time and previous version + 1, so versions of rolled back changes
+    are not repeated by later ones"""
+    if not is_process_local(get_cache()):
+        transaction.on_commit(_bump_shared_version)
+        version, modified = _new_version()
+        _uncommitted_version.set((-version, modified))
+        _forget()
+        return
+    TreeVersion = apps.get_model("menu_maker", "TreeVersion")
+    now = timezone.now()
+    version = Greatest(F("version") + 1, Value(time.time_ns()))
+    if not TreeVersion.objects.filter(id=1).update(version=version, modified=now):
+        _create_tree_version()
+    _forget()
+
+
+def get_tree_modified() -> int:
+    """returns unix time of last tree change"""
+    return _get_version()[1]
+
+
+def cache_key(kind: str, root: str, version: int) -> str:
+    digest = hashlib.md5(root.encode()).hexdigest()
+    return f"menu_maker:{kind}:{version}:{digest}"
+
+
+def get_many(kind: str, roots: Iterable[str], version: int) -> Dict[str, Any]:
+    """returns cached entries of given kind ("tree", "fragment" or "children")
+    by root"""
+    keys = {cache_key(kind, root, version): root for root in roots}
+    return {keys[key]: value for key, value in get_cache().get_many(keys).items()}
+
+
+def set_many(kind: str, entries: Dict[str, Any], version: int):
+    if version < 0:
+        # read from uncommitted rows
+        return
+    get_cache().set_many(
+        {cache_key(kind, root, version): value for root, value in entries.items()},
+        conf.get("CACHE_TIMEOUT"),
+    )
+
+
+async def aget_many(kind: str, roots: Iterable[str], version: int) -> Dict[str, Any]:
+    keys = {cache_key(kind, root, version): root for root in roots}
+    values = await get_cache().aget_many(keys)
+    return {keys[key]: value for key, value in values.items()}
+
+
+async def aset_many(kind: str, entries: Dict[str, Any], version: int):
+    if version < 0:
+        return
+    await get_cache().aset_many(
+        {cache_key(kind, root, version): value for root, value in entries.items()},
+        conf.get("CACHE_TIMEOUT"),
+    )
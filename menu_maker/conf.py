@@ -0,0 +1,44 @@
+from typing import Any
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULTS = {
+    # alias of django cache backend used for menu trees. Shared backends also
+    # keep tree version, so warm pages need no queries. With process-local
+    # backends version is kept in database, read once per request, and each
+    # process loads and renders menus on its own
+    "CACHE_ALIAS": "default",
+    # seconds to keep a cached tree, None to keep until evicted
+    "CACHE_TIMEOUT": None,
+    # distance between neighbouring lft/rgt values. 1 keeps numbering dense,
+    # values of 3 and above leave gaps, so new items take free numbers without
+    # shifting the rest of the table, until a gap is exhausted and tree is
+    # renumbered again. 2 is rejected, as it leaves no room for a new item
+    "SPACING": 1,
+    # seconds browsers and shared caches may reuse children responses
+    # without revalidating them by ETag
+    "CHILDREN_MAX_AGE": 60,
+    # attempts to repeat tree change after SQLite "database is locked" error,
+    # and delay in seconds before first of them, doubled for each next one
+    "LOCK_RETRIES": 3,
+    "LOCK_RETRY_DELAY": 0.05,
+    # callable, or its dotted path, called with MenuTiming of each drawn menu
+    "METRICS_HOOK": None,
+    # build all root menus into cache when application starts
+    "WARM_ON_STARTUP": False,
+    # file of binary tree snapshot shared by worker processes, which trees are
+    # read from instead of database. None disables snapshot
+    "SNAPSHOT_PATH": None,
+}
+
+
+def get(name: str) -> Any:
+    """returns menu_maker setting, which can be overriden in project settings
+    with MENU_MAKER_ prefix, e.g. MENU_MAKER_CACHE_TIMEOUT"""
+    value = getattr(settings, f"MENU_MAKER_{name}", DEFAULTS[name])
+    if name == "SPACING" and (not isinstance(value, int) or value < 1 or value == 2):
+        raise ImproperlyConfigured(
+            "MENU_MAKER_SPACING must be 1 for dense or at least 3 for gapped"
+            f" numbering, not {value!r}"
+        )
+    return value
@@ -16,8 +16,10 @@ class MenuItemForm(forms.ModelForm):
             self.fields["position"].initial = position[0] - 1
 
     def save(self, commit: bool = True):
-        input_pos = self.cleaned_data["position"]
-        self.instance.set_new_position(input_pos)
+        # unchanged position under the same parent does not need moving the node
+        if "position" in self.changed_data or "parent" in self.changed_data:
+            input_pos = self.cleaned_data["position"]
+            self.instance.set_new_position(input_pos)
         return super().save(commit)
 
     class Meta:
@@ -0,0 +1,170 @@
+"""Timings of menu drawing.
+
+Each drawn menu, and each batch of menus loaded at once, is measured: total time,
+number and time of queries, time spent annotating nodes and rendering html,
+number of nodes and whether the menu came from cache. Measurements are logged
+as "menu_maker.instrumentation" records with the values in the menu_timing
+attribute, passed to METRICS_HOOK setting and, with server_timing_middleware,
+sent in Server-Timing header of the response.
+"""
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import quote
+from django.utils.module_loading import import_string
+from menu_maker import conf
+
+logger = logging.getLogger(__name__)
+
+
+class MenuTiming:
+    """measurements of drawing one menu, times are in seconds"""
+
+    __slots__ = (
+        "name",
+        "duration",
+        "queries",
+        "db_time",
+        "annotate_time",
+        "render_time",
+        "nodes",
+        "cache_hit",
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.annotate_time = 0.0
+        self.render_time = 0.0
+        self.nodes = 0
+        # None until menu is looked up in cache
+        self.cache_hit: Optional[bool] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def server_timing(self) -> str:
+        """returns metric of Server-Timing header, with details in description"""
+        status = {True: "hit", False: "miss", None: "-"}[self.cache_hit]
+        # header value must stay ASCII, or the whole header gets MIME-encoded
+        name = "".join(
+            char if " " <= char <= "~" and char != "%" else quote(char)
+            for char in self.name
+        )
+        name = name.replace("\\", "\\\\").replace('"', '\\"')
+        description = (
+            f"{name} {status} nodes={self.nodes} queries={self.queries}"
+            f" db={self.db_time * 1000:.2f} annotate={self.annotate_time * 1000:.2f}"
+            f" render={self.render_time * 1000:.2f}"
+        )
+        return f'menu;dur={self.duration * 1000:.2f};desc="{description}"'
+
+
+# measurement in progress, which inner steps add to
+_current: ContextVar[Optional[MenuTiming]] = ContextVar(
+    "menu_maker_timing", default=None
+)
+# measurements of current request, collected by server_timing_middleware
+_request_timings: ContextVar[Optional[List[MenuTiming]]] = ContextVar(
+    "menu_maker_request_timings", default=None
+)
+
+
+def current() -> Optional[MenuTiming]:
+    return _current.get()
+
+
+@contextmanager
+def measure(name: str) -> Iterator[MenuTiming]:
+    """measures drawing or loading of menus. Measurements started inside of
+    another one are counted in the outer one"""
+    timing = _current.get()
+    if timing is not None:
+        yield timing
+        return
+
+    timing = MenuTiming(name)
+    token = _current.set(timing)
+    start = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.duration = time.perf_counter() - start
+        _current.reset(token)
+        _report(timing)
+
+
+@contextmanager
+def timer(field: str) -> Iterator[None]:
+    """adds time of the block to given field of current measurement"""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(timing, field, getattr(timing, field) + time.perf_counter() - start)
+
+
+def count_query(execute: Callable, sql: str, params: Any, many: bool, context: Dict):
+    """database execute wrapper, installed on every connection by MenuMakerConfig.
+    Context variables are copied into threads running async queries, so these
+    queries are counted too"""
+    timing = _current.get()
+    if timing is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timing.queries += 1
+        timing.db_time += time.perf_counter() - start
+
+
+def start_request() -> Token:
+    return _request_timings.set([])
+
+
+def end_request(token: Token) -> List[MenuTiming]:
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    return timings
+
+
+@functools.lru_cache(maxsize=None)
+def _import_hook(path: str) -> Callable[[MenuTiming], Any]:
+    return import_string(path)
+
+
+def _get_hook() -> Optional[Callable[[MenuTiming], Any]]:
+    hook = conf.get("METRICS_HOOK")
+    if isinstance(hook, str):
+        # dotted path is imported once, not on every measurement
+        hook = _import_hook(hook)
+    return hook
+
+
+def _report(timing: MenuTiming):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append(timing)
+    logger.info(
+        "Menu %s drawn in %.2fms",
+        timing.name,
+        timing.duration * 1000,
+        extra={"menu_timing": timing.as_dict()},
+    )
+    hook = _get_hook()
+    if hook is not None:
+        # broken metrics must not break pages
+        try:
+            hook(timing)
+        except Exception:
+            logger.exception("Error in menu metrics hook")
@@ -0,0 +1,32 @@
+from typing import Any
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from menu_maker.models import MenuItem
+
+
+class Command(BaseCommand):
+    help = "Validate nested sets of menu trees, and rebuild them from parent links"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--tree-id", type=int, help="tree to check, all by default")
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="rebuild lft and rgt of all trees if problems are found",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        problems = MenuItem.objects.check_tree(options["tree_id"])
+        for problem in problems:
+            self.stderr.write(problem)
+        if not problems:
+            self.stdout.write("Menu trees are valid")
+            return
+        if not options["rebuild"]:
+            raise CommandError(f"Found {len(problems)} problems, use --rebuild")
+
+        try:
+            updated = MenuItem.objects.rebuild(batch_size=options["batch_size"])
+        except ValueError as err:
+            raise CommandError(str(err))
+        self.stdout.write(f"Rebuilt menu trees, updated {updated} menu items")
@@ -0,0 +1,31 @@
+from typing import Any
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.http import Http404
+from menu_maker.models import MenuItem
+from menu_maker.tree_io import WRITE_FORMATS, write_tree
+
+
+class Command(BaseCommand):
+    help = "Stream menu tree, or all trees, as json, jsonl or csv"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("root", nargs="?", help="name or slug of tree root")
+        parser.add_argument("--format", choices=WRITE_FORMATS, default="jsonl")
+        parser.add_argument("--output", help="file to write, stdout by default")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        try:
+            # unknown root is reported before output file is created
+            records = MenuItem.objects.iter_records(
+                options["root"], chunk_size=options["chunk_size"]
+            )
+        except Http404:
+            raise CommandError(f"Menu item {options['root']} does not exist")
+
+        if options["output"]:
+            with open(options["output"], "w", newline="", encoding="utf-8") as stream:
+                write_tree(records, stream, options["format"])
+        else:
+            self.stdout.ending = ""
+            write_tree(records, self.stdout, options["format"])
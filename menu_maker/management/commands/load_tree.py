@@ -0,0 +1,37 @@
+import sys
+from typing import Any
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import IntegrityError
+from menu_maker.models import MenuItem
+from menu_maker.tree_io import FORMATS, guess_format, read_tree
+
+
+class Command(BaseCommand):
+    help = "Bulk load menu trees from json, jsonl, csv or yaml file"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("path", help="file to load, or - for stdin")
+        parser.add_argument(
+            "--format", choices=FORMATS, help="file format, guessed by extension"
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        path = options["path"]
+        try:
+            format = options["format"] or guess_format(path)
+            if path == "-":
+                tree = read_tree(sys.stdin, format)
+            else:
+                with open(path, newline="", encoding="utf-8") as stream:
+                    tree = read_tree(stream, format)
+        except (OSError, ValueError, KeyError) as err:
+            raise CommandError(f"Can not read {path}: {err}")
+
+        try:
+            items = MenuItem.objects.bulk_load_tree(
+                tree, batch_size=options["batch_size"]
+            )
+        except IntegrityError as err:
+            raise CommandError(f"Can not load {path}: {err}")
+        self.stdout.write(f"Loaded {len(items)} menu items")
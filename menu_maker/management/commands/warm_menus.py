@@ -0,0 +1,24 @@
+from typing import Any
+from django.core.management.base import BaseCommand, CommandParser
+from menu_maker.cache import get_cache, is_process_local
+from menu_maker.templatetags.draw_menu import warm_menus
+
+
+class Command(BaseCommand):
+    help = "Build trees and rendered html of all root menus into cache"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size", type=int, default=100, help="trees loaded by one query"
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if is_process_local(get_cache()):
+            self.stderr.write(
+                "Menu cache is local to this process, server processes are not"
+                " warmed up. Use a shared cache backend, or WARM_ON_STARTUP setting"
+            )
+        names = warm_menus(batch_size=options["batch_size"])
+        self.stdout.write(
+            f"Warmed up {len(names)} menus" + "".join(f"\n  {name}" for name in names)
+        )
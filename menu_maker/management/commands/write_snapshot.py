@@ -0,0 +1,20 @@
+from typing import Any
+from django.core.management.base import BaseCommand, CommandError
+from menu_maker import cache, conf
+from menu_maker.snapshot import update_snapshot
+
+
+class Command(BaseCommand):
+    help = "Write binary snapshot of all menu trees to SNAPSHOT_PATH setting"
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        path = conf.get("SNAPSHOT_PATH")
+        if not path:
+            raise CommandError("MENU_MAKER_SNAPSHOT_PATH setting is not set")
+        if update_snapshot():
+            self.stdout.write(f"Written snapshot of all menu trees to {path}")
+        else:
+            self.stdout.write(
+                f"Snapshot {path} is up to date with tree version"
+                f" {cache.get_tree_version()}"
+            )
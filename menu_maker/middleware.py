@@ -0,0 +1,75 @@
+import asyncio
+from typing import List
+from django.http import HttpRequest, HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.functional import SimpleLazyObject
+from menu_maker import cache, instrumentation
+from menu_maker.templatetags.draw_menu import MenuRegistry
+
+
+def _add_server_timing(
+    response: HttpResponse, timings: List[instrumentation.MenuTiming]
+):
+    if not timings:
+        return
+    metrics = [timing.server_timing() for timing in timings]
+    if response.has_header("Server-Timing"):
+        metrics.insert(0, response["Server-Timing"])
+    response["Server-Timing"] = ", ".join(metrics)
+
+
+@sync_and_async_middleware
+def server_timing_middleware(get_response):
+    """adds Server-Timing header with a metric for every menu drawn or loaded
+    while handling request, so that browser dev tools show time spent in menus"""
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request: HttpRequest) -> HttpResponse:
+            token = instrumentation.start_request()
+            try:
+                response = await get_response(request)
+            finally:
+                timings = instrumentation.end_request(token)
+            _add_server_timing(response, timings)
+            return response
+
+    else:
+
+        def middleware(request: HttpRequest) -> HttpResponse:
+            token = instrumentation.start_request()
+            try:
+                response = get_response(request)
+            finally:
+                timings = instrumentation.end_request(token)
+            _add_server_timing(response, timings)
+            return response
+
+    return middleware
+
+
+@sync_and_async_middleware
+def menu_registry_middleware(get_response):
+    """sets request.menu_registry shared by view and menu tags. It is created on
+    first access, when url is already resolved and active item slug is known.
+    Tree version is read once for the whole request"""
+
+    def set_registry(request: HttpRequest):
+        request.menu_registry = SimpleLazyObject(
+            lambda: MenuRegistry.from_request(request)
+        )
+
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request: HttpRequest) -> HttpResponse:
+            set_registry(request)
+            with cache.version_scope():
+                return await get_response(request)
+
+    else:
+
+        def middleware(request: HttpRequest) -> HttpResponse:
+            set_registry(request)
+            with cache.version_scope():
+                return get_response(request)
+
+    return middleware
@@ -0,0 +1,40 @@
+# Generated by Django 4.1.7 on 2026-10-18 14:44
+
+from django.db import migrations, models
+
+
+def fill_depth_and_path(apps, schema_editor):
+    MenuItem = apps.get_model("menu_maker", "MenuItem")
+    changed = []
+    # ancestors of current item as (rgt, path)
+    stack = []
+    for item in MenuItem.objects.order_by("lft").only("lft", "rgt", "slug"):
+        while stack and stack[-1][0] < item.lft:
+            stack.pop()
+        item.depth = len(stack)
+        item.path = f"{stack[-1][1]}/{item.slug}" if stack else item.slug
+        stack.append((item.rgt, item.path))
+        changed.append(item)
+    MenuItem.objects.bulk_update(changed, ["depth", "path"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("menu_maker", "0004_alter_menuitem_slug"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="menuitem",
+            name="depth",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="menuitem",
+            name="path",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=1000
+            ),
+        ),
+        migrations.RunPython(fill_depth_and_path, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.7 on 2026-10-18 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("menu_maker", "0005_menuitem_depth_path"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="menuitem",
+            index=models.Index(fields=["lft", "rgt"], name="menuitem_lft_rgt_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="menuitem",
+            index=models.Index(
+                fields=["parent", "lft"], name="menuitem_parent_lft_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="menuitem",
+            index=models.Index(fields=["name"], name="menuitem_name_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="menuitem",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("parent__isnull", True)),
+                fields=("slug",),
+                name="unique_root_slug",
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 14:52
+
+from django.db import migrations, models
+
+
+def create_lock_row(apps, schema_editor):
+    TreeLock = apps.get_model("menu_maker", "TreeLock")
+    TreeLock.objects.get_or_create(id=1)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("menu_maker", "0006_menuitem_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TreeLock",
+            fields=[
+                (
+                    "id",
+                    models.PositiveSmallIntegerField(primary_key=True, serialize=False),
+                ),
+                ("counter", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_lock_row, migrations.RunPython.noop),
+    ]
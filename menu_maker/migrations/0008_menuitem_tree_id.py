@@ -0,0 +1,60 @@
+# Generated by Django 4.1.7 on 2026-10-18 14:57
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def split_trees(apps, schema_editor):
+    MenuItem = apps.get_model("menu_maker", "MenuItem")
+    TreeLock = apps.get_model("menu_maker", "TreeLock")
+    roots = MenuItem.objects.filter(parent=None).order_by("lft")
+    for tree_id, (lft, rgt) in enumerate(roots.values_list("lft", "rgt"), 1):
+        # every tree is numbered from 1
+        offset = lft - 1
+        MenuItem.objects.filter(tree_id=0, lft__range=(lft, rgt)).update(
+            tree_id=tree_id, lft=F("lft") - offset, rgt=F("rgt") - offset
+        )
+    # lock guarding allocation of tree ids
+    TreeLock.objects.get_or_create(id=0)
+
+
+def join_trees(apps, schema_editor):
+    MenuItem = apps.get_model("menu_maker", "MenuItem")
+    offset = 0
+    roots = MenuItem.objects.filter(parent=None).order_by("tree_id")
+    for tree_id, lft, rgt in roots.values_list("tree_id", "lft", "rgt"):
+        MenuItem.objects.filter(tree_id=tree_id).update(
+            lft=F("lft") + offset, rgt=F("rgt") + offset
+        )
+        offset += rgt
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("menu_maker", "0007_treelock"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="menuitem",
+            name="menuitem_lft_rgt_idx",
+        ),
+        migrations.AddField(
+            model_name="menuitem",
+            name="tree_id",
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(split_trees, join_trees),
+        migrations.AlterField(
+            model_name="treelock",
+            name="id",
+            field=models.PositiveIntegerField(primary_key=True, serialize=False),
+        ),
+        migrations.AddIndex(
+            model_name="menuitem",
+            index=models.Index(
+                fields=["tree_id", "lft", "rgt"], name="menuitem_tree_lft_rgt_idx"
+            ),
+        ),
+    ]
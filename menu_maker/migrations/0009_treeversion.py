@@ -0,0 +1,38 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:26
+
+import time
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_version_row(apps, schema_editor):
+    TreeVersion = apps.get_model("menu_maker", "TreeVersion")
+    TreeVersion.objects.get_or_create(
+        id=1, defaults={"version": time.time_ns(), "modified": timezone.now()}
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("menu_maker", "0008_menuitem_tree_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TreeVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.PositiveBigIntegerField()),
+                ("modified", models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(create_version_row, migrations.RunPython.noop),
+    ]
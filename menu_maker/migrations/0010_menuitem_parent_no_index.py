@@ -0,0 +1,24 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("menu_maker", "0009_treeversion"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="menuitem",
+            name="parent",
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="menu_maker.menuitem",
+            ),
+        ),
+    ]
@@ -1,37 +1,826 @@
-from typing import Optional, Tuple, Union
-from django.db import models
-from django.db.models import CheckConstraint, Q, F, Max
+import functools
+import logging
+import random
+import time
+from bisect import bisect_left, bisect_right
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from django.db import OperationalError, models, transaction
+from django.db.models import (
+    Case,
+    CheckConstraint,
+    Count,
+    Exists,
+    F,
+    Index,
+    Max,
+    OuterRef,
+    Q,
+    QuerySet,
+    Subquery,
+    UniqueConstraint,
+    Value,
+    When,
+)
+from django.db.models.functions import Concat, Substr
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import slugify
 from django.utils.safestring import SafeString
+from menu_maker import cache, conf, snapshot
+from menu_maker.cache import TreeRow
+
+
+_NOT_LOADED = object()
+
+logger = logging.getLogger(__name__)
+
+
+def _is_gapped() -> bool:
+    return conf.get("SPACING") > 1
+
+
+def _lock_trees(*tree_ids: int):
+    """takes locks of given trees by updating their lock rows, which blocks other
+    changes of the same trees until current transaction ends. Lock of tree 0
+    guards allocation of new tree ids. Being a write, locking also makes SQLite
+    take its write lock before any reads of the tree"""
+    for tree_id in sorted(set(tree_ids)):
+        if not TreeLock.objects.filter(id=tree_id).update(counter=F("counter") + 1):
+            TreeLock.objects.get_or_create(id=tree_id)
+            TreeLock.objects.filter(id=tree_id).update(counter=F("counter") + 1)
+
+
+def _next_tree_id() -> int:
+    """returns id for a new tree, holding the allocation lock until commit"""
+    _lock_trees(0)
+    return (MenuItem.objects.aggregate(Max("tree_id"))["tree_id__max"] or 0) + 1
+
+
+def _is_locked_error(err: OperationalError) -> bool:
+    return "database is locked" in str(err)
+
+
+def _tree_mutation(func: Callable) -> Callable:
+    """runs tree mutation in transaction, in which it takes locks of changed
+    trees. Outside of other transactions mutation is retried when SQLite
+    reports "database is locked", restoring state of model instance between
+    attempts. Retries are logged as warnings, and operation of model instance
+    failed by its last attempt as error"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = conf.get("LOCK_RETRIES")
+        if transaction.get_connection().in_atomic_block:
+            # outer transaction can not be repeated from here
+            retries = 0
+        instance = args[0] if isinstance(args[0], models.Model) else None
+        if instance:
+            instance.__dict__.pop("_failed_operation", None)
+        state = instance.__dict__.copy() if instance else None
+
+        for attempt in range(retries + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except Exception as err:
+                if (
+                    attempt == retries
+                    or not isinstance(err, OperationalError)
+                    or not _is_locked_error(err)
+                ):
+                    operation = getattr(instance, "_failed_operation", None)
+                    if operation:
+                        logger.exception("Error when %s", operation)
+                    raise
+                if instance:
+                    instance.__dict__.clear()
+                    instance.__dict__.update(state)
+                delay = conf.get("LOCK_RETRY_DELAY") * 2**attempt
+                delay *= random.uniform(0.5, 1.5)
+                logger.warning(
+                    "Database is locked, retrying %s in %.3f s",
+                    func.__qualname__,
+                    delay,
+                )
+                time.sleep(delay)
+
+    return wrapper
+
+
+def _bump_tree_version():
+    cache.bump_tree_version()
+    snapshot.schedule_update()
+
+
+def _allocate(boundary: int, next_boundary: int, min_width: int) -> Tuple[int, int]:
+    """returns lft and rgt for a node of at least min_width placed in the middle
+    of a free gap between boundary and next_boundary, taking up to SPACING values
+    for node itself, so that its future children also have free numbers"""
+    free = next_boundary - boundary - 1
+    width = max(min_width, min(free // 2, conf.get("SPACING")))
+    lft = boundary + 1 + (free - width) // 2
+    return lft, lft + width - 1
 
 
 class MenuManager(models.Manager):
-    def get_tree(self, root: Union[int, str, SafeString]):
+    def get_tree(
+        self, root: Union[int, str, SafeString], max_depth: Optional[int] = None
+    ):
         """retrives tree with root and all descendants
         Args:
             root (Union[int, str, SafeString]): id or name of root node
+            max_depth (Optional[int]): number of levels below root to include,
+            all levels if None
         """
+        root = self._get_root(root)
+        tree = self.filter(tree_id=root.tree_id, lft__range=(root.lft, root.rgt))
+        if max_depth is not None:
+            tree = tree.filter(depth__lte=root.depth + max_depth)
+        return tree.order_by("lft")
+
+    async def aget_tree(
+        self, root: Union[int, str, SafeString], max_depth: Optional[int] = None
+    ) -> List["MenuItem"]:
+        """asynchronous get_tree, returns evaluated list of items"""
+        root = await self._aget_root(root)
+        tree = self.filter(tree_id=root.tree_id, lft__range=(root.lft, root.rgt))
+        if max_depth is not None:
+            tree = tree.filter(depth__lte=root.depth + max_depth)
+        return [item async for item in tree.order_by("lft")]
+
+    def get_expanded_tree(
+        self,
+        root: Union[int, str, SafeString],
+        active: Optional[str] = None,
+        max_depth: int = 1,
+    ):
+        """retrieves only items visible in collapsed menu: levels up to max_depth
+        below root, and children of active item and of each of its ancestors,
+        i.e. siblings of active path. Items are annotated with has_children,
+        since children of collapsed items are not retrieved
+
+        Args:
+            root (Union[int, str, SafeString]): id or name of root node
+            active (Optional[str]): slug of active item, first one by lft
+            if repeated
+            max_depth (int): number of levels below root always included
+        """
+        root = self._get_root(root)
+        tree = self.filter(tree_id=root.tree_id, lft__range=(root.lft, root.rgt))
+        visible = Q(depth__lte=root.depth + max_depth)
+        if active:
+            active_item = tree.filter(slug=active).order_by("lft")[:1]
+            expanded = tree.filter(
+                lft__lte=Subquery(active_item.values("lft")),
+                rgt__gte=Subquery(active_item.values("rgt")),
+            )
+            visible |= Q(parent__in=expanded.values("id"))
+        return (
+            tree.filter(visible)
+            .annotate(has_children=Exists(self.filter(parent=OuterRef("pk"))))
+            .order_by("lft")
+        )
+
+    def _get_root(self, root: Union[int, str, SafeString]) -> "MenuItem":
+        return get_object_or_404(MenuItem, self._root_lookup(root))
+
+    async def _aget_root(self, root: Union[int, str, SafeString]) -> "MenuItem":
+        try:
+            return await self.aget(self._root_lookup(root))
+        except MenuItem.DoesNotExist:
+            raise Http404("No MenuItem matches the given query.")
+
+    @staticmethod
+    def _root_lookup(root: Union[int, str, SafeString]) -> Q:
         if type(root) == int:
-            q = Q(id=root)
+            return Q(id=root)
         elif type(root) == str or type(root) == SafeString:
-            q = Q(name=root) | Q(slug=root)
-        else:
-            raise TypeError(
-                "root argument should be either int for id or str|SafeString for name lookup"
-            )
+            return Q(name=root) | Q(slug=root)
+        raise TypeError(
+            "root argument should be either int for id or str|SafeString for name lookup"
+        )
+
+    def get_ancestors(self, id: int, include_self: bool = False):
+        """retrieves ancestors of node from root down to parent (or node itself
+        if include_self), e.g. for breadcrumbs, by single query"""
+        node = self.filter(id=id)
+        ancestors = self.filter(
+            tree_id=Subquery(node.values("tree_id")),
+            lft__lte=Subquery(node.values("lft")),
+            rgt__gte=Subquery(node.values("rgt")),
+        )
+        if not include_self:
+            ancestors = ancestors.exclude(id=id)
+        return ancestors.order_by("lft")
+
+    def get_by_path(self, path: str) -> "MenuItem":
+        """retrieves node by slugs of its ancestors and itself joined by "/",
+        e.g. clothing/womens/dresses"""
+        return get_object_or_404(MenuItem, path=path.strip("/"))
+
+    def get_cached_tree(self, root: Union[str, SafeString]) -> Tuple[TreeRow, ...]:
+        """same as get_tree, but returns rows from versioned cache,
+        querying database only when tree has been changed since last call
+        Args:
+            root (Union[str, SafeString]): name or slug of root node
+        """
+        trees = self.get_cached_trees([root])
+        if str(root) not in trees:
+            raise Http404("No MenuItem matches the given query.")
+        return trees[str(root)]
+
+    def get_cached_trees(
+        self, roots: Iterable[Union[str, SafeString]]
+    ) -> Dict[str, Tuple[TreeRow, ...]]:
+        """returns rows of several trees by root name or slug, loading trees
+        missing from cache with two queries in total. Unknown roots are skipped
+        Args:
+            roots (Iterable[Union[str, SafeString]]): names or slugs of root nodes
+        """
+        roots = [str(root) for root in roots]
+        version = cache.get_tree_version()
+        tree_snapshot = snapshot.get_snapshot(version)
+        if tree_snapshot is not None:
+            # rows are read from mapping shared by processes, not cached by each
+            return self._snapshot_trees(tree_snapshot, roots)
+        trees = cache.get_many("tree", roots, version)
+        missing = [root for root in roots if root not in trees]
+        if not missing:
+            return trees
+
+        top_nodes = list(self._top_nodes(missing))
+        if not top_nodes:
+            return trees
+        rows = [
+            (values[0], TreeRow(*values[1:])) for values in self._tree_rows(top_nodes)
+        ]
+        loaded = self._split_trees(missing, top_nodes, rows)
+        cache.set_many("tree", loaded, version)
+        trees.update(loaded)
+        return trees
+
+    async def aget_cached_trees(
+        self, roots: Iterable[Union[str, SafeString]]
+    ) -> Dict[str, Tuple[TreeRow, ...]]:
+        """asynchronous get_cached_trees"""
+        roots = [str(root) for root in roots]
+        version = await cache.aget_tree_version()
+        tree_snapshot = snapshot.get_snapshot(version)
+        if tree_snapshot is not None:
+            return self._snapshot_trees(tree_snapshot, roots)
+        trees = await cache.aget_many("tree", roots, version)
+        missing = [root for root in roots if root not in trees]
+        if not missing:
+            return trees
+
+        top_nodes = [values async for values in self._top_nodes(missing)]
+        if not top_nodes:
+            return trees
+        rows = [
+            (values[0], TreeRow(*values[1:]))
+            async for values in self._tree_rows(top_nodes)
+        ]
+        loaded = self._split_trees(missing, top_nodes, rows)
+        await cache.aset_many("tree", loaded, version)
+        trees.update(loaded)
+        return trees
+
+    def _top_nodes(self, roots: List[str]) -> QuerySet:
+        return (
+            self.filter(Q(name__in=roots) | Q(slug__in=roots))
+            .order_by("tree_id", "lft")
+            .values_list("name", "slug", "tree_id", "lft", "rgt")
+        )
+
+    def _tree_rows(self, top_nodes: List[Tuple[str, str, int, int, int]]) -> QuerySet:
+        ranges = Q()
+        for _, _, tree_id, lft, rgt in top_nodes:
+            ranges |= Q(tree_id=tree_id, lft__range=(lft, rgt))
+        return (
+            self.filter(ranges)
+            .order_by("tree_id", "lft")
+            .values_list("tree_id", *TreeRow._fields)
+        )
+
+    @staticmethod
+    def _snapshot_trees(
+        tree_snapshot: snapshot.Snapshot, roots: List[str]
+    ) -> Dict[str, Tuple[TreeRow, ...]]:
+        trees = {}
+        for root in roots:
+            tree = tree_snapshot.get_tree(root)
+            if tree is not None:
+                trees[root] = tree
+        return trees
 
-        root = get_object_or_404(MenuItem, q)
-        return self.filter(lft__range=(root.lft, root.rgt)).order_by("lft")
+    @staticmethod
+    def _split_trees(
+        roots: List[str],
+        top_nodes: List[Tuple[str, str, int, int, int]],
+        rows: List[Tuple[int, TreeRow]],
+    ) -> Dict[str, Tuple[TreeRow, ...]]:
+        keys = [(tree_id, row.lft) for tree_id, row in rows]
+        trees = {}
+        for root in roots:
+            top = next((n for n in top_nodes if root in (n[0], n[1])), None)
+            if top:
+                _, _, tree_id, lft, rgt = top
+                start = bisect_left(keys, (tree_id, lft))
+                end = bisect_right(keys, (tree_id, rgt), lo=start)
+                trees[root] = tuple(row for _, row in rows[start:end])
+        return trees
 
     def get_descendants(self, id: int, direct_only: bool = False):
         top = get_object_or_404(MenuItem, id=id)
+        descendants = self.filter(
+            tree_id=top.tree_id, lft__range=(top.lft + 1, top.rgt - 1)
+        )
+        if direct_only:
+            return descendants.filter(parent=top).order_by("lft")
+        else:
+            return descendants.order_by("lft")
+
+    async def aget_descendants(
+        self, id: int, direct_only: bool = False
+    ) -> List["MenuItem"]:
+        """asynchronous get_descendants, returns evaluated list of items"""
+        try:
+            top = await self.aget(id=id)
+        except MenuItem.DoesNotExist:
+            raise Http404("No MenuItem matches the given query.")
+        descendants = self.filter(
+            tree_id=top.tree_id, lft__range=(top.lft + 1, top.rgt - 1)
+        )
         if direct_only:
-            return self.filter(
-                lft__range=(top.lft + 1, top.rgt - 1), parent=top
-            ).order_by("lft")
+            descendants = descendants.filter(parent=top)
+        return [item async for item in descendants.order_by("lft")]
+
+    @_tree_mutation
+    def bulk_load_tree(
+        self, tree: Sequence[Dict[str, Any]], batch_size: int = 1000
+    ) -> List["MenuItem"]:
+        """inserts nested items as new trees, each root item with its own tree_id,
+        computing lft and rgt in a single pass and creating items level by level
+        in batches
+
+        Args:
+            tree (Sequence[Dict[str, Any]]): root items, each a mapping with "name",
+            optional "slug" and optional "children" list of such items
+            batch_size (int): number of items inserted by one query
+
+        Returns:
+            List[MenuItem]: created items in lft order
+        """
+        spacing = conf.get("SPACING")
+        items = []
+        parents = []
+        levels = []
+
+        first_tree_id = _next_tree_id()
+        tree_id = first_tree_id - 1
+        counter = 0
+        # stack of item index and iterator over its children
+        pending = [(None, iter(tree))]
+        while pending:
+            index, children = pending[-1]
+            child = next(children, None)
+            if child is None:
+                pending.pop()
+                if index is not None:
+                    counter += spacing
+                    items[index].rgt = counter
+                continue
+
+            if index is None:  # new tree
+                tree_id += 1
+                counter = 0
+            counter += spacing
+            slug = child.get("slug") or slugify(child["name"])
+            items.append(
+                MenuItem(
+                    name=child["name"],
+                    slug=slug,
+                    tree_id=tree_id,
+                    lft=counter,
+                    depth=len(pending) - 1,
+                    path=slug if index is None else f"{items[index].path}/{slug}",
+                )
+            )
+            parents.append(index)
+            if len(levels) < len(pending):
+                levels.append([])
+            levels[len(pending) - 1].append(len(items) - 1)
+            pending.append((len(items) - 1, iter(child.get("children") or ())))
+
+        for level in levels:
+            level_items = []
+            for index in level:
+                if parents[index] is not None:
+                    items[index].parent = items[parents[index]]
+                level_items.append(items[index])
+            self.bulk_create(level_items, batch_size=batch_size)
+
+            # backends without returning inserted rows
+            if level_items[0].pk is None:
+                ids = {
+                    (tree_id, lft): id
+                    for tree_id, lft, id in self.filter(
+                        tree_id__gte=first_tree_id
+                    ).values_list("tree_id", "lft", "id")
+                }
+                for item in level_items:
+                    item.pk = ids[item.tree_id, item.lft]
+
+        _bump_tree_version()
+        return items
+
+    def iter_records(
+        self, root: Union[int, str, SafeString, None] = None, chunk_size: int = 2000
+    ) -> Iterator[Dict[str, Any]]:
+        """streams flat records of a tree, or of all trees if root is None,
+        ordered by tree and lft without loading all items into memory. Records have
+        "id", "parent", "name" and "slug" keys, parent of the top item is None,
+        so that subtree export can be loaded back as a separate tree. Root is
+        looked up when called, before any record is read
+
+        Args:
+            root (Union[int, str, SafeString, None]): id or name of root node
+            chunk_size (int): number of rows fetched from database at once
+
+        Raises:
+            Http404: if there is no such root
+        """
+        if root is not None:
+            queryset = self.get_tree(root)
         else:
-            return self.filter(lft__range=(top.lft + 1, top.rgt - 1)).order_by("lft")
+            queryset = self.order_by("tree_id", "lft")
+        values = queryset.values_list("id", "parent_id", "name", "slug")
+        return self._records(values.iterator(chunk_size=chunk_size))
+
+    @staticmethod
+    def _records(
+        values: Iterator[Tuple[int, int, str, str]]
+    ) -> Iterator[Dict[str, Any]]:
+        top_id = None
+        for id, parent_id, name, slug in values:
+            if top_id is None:
+                top_id = id
+            yield {
+                "id": id,
+                "parent": None if id == top_id else parent_id,
+                "name": name,
+                "slug": slug,
+            }
+
+    @_tree_mutation
+    def delete_nodes(self, ids: Union[Iterable[int], QuerySet]) -> int:
+        """deletes items with all descendants. Selection is collapsed into
+        outermost subtrees, which are deleted by one query, and then numbering
+        gaps are closed by single update per affected tree
+
+        Args:
+            ids (Union[Iterable[int], QuerySet]): ids of items, or queryset of ids
+
+        Returns:
+            int: number of deleted items
+        """
+        selected = self.filter(id__in=ids)
+        _lock_trees(*selected.values_list("tree_id", flat=True).distinct())
+
+        # outermost ranges by tree
+        ranges: Dict[int, List[Tuple[int, int]]] = {}
+        values = selected.order_by("tree_id", "lft").values_list(
+            "tree_id", "lft", "rgt"
+        )
+        for tree_id, lft, rgt in values:
+            tree_ranges = ranges.setdefault(tree_id, [])
+            if not tree_ranges or lft > tree_ranges[-1][1]:
+                tree_ranges.append((lft, rgt))
+        if not ranges:
+            return 0
+
+        condition = Q()
+        for tree_id, tree_ranges in ranges.items():
+            for lft, rgt in tree_ranges:
+                condition |= Q(tree_id=tree_id, lft__range=(lft, rgt))
+        # ranges hold every descendant already, deleting them through collector
+        # still sends signals and deletes rows of other models referring to them
+        _, deleted_by_model = self.filter(condition).delete()
+        deleted = deleted_by_model.get(self.model._meta.label, 0)
+
+        if not _is_gapped():
+            for tree_id, tree_ranges in ranges.items():
+                self.filter(tree_id=tree_id, rgt__gt=tree_ranges[0][0]).update(
+                    lft=self._close_ranges("lft", tree_ranges),
+                    rgt=self._close_ranges("rgt", tree_ranges),
+                )
+
+        _bump_tree_version()
+        return deleted
+
+    @staticmethod
+    def _close_ranges(field: str, ranges: List[Tuple[int, int]]) -> Case:
+        # values after each deleted range move left by width of all ranges before
+        whens = []
+        width = 0
+        for lft, rgt in ranges:
+            width += rgt - lft + 1
+            whens.append(When(**{f"{field}__gt": rgt}, then=F(field) - width))
+        return Case(
+            *reversed(whens),
+            default=F(field),
+            output_field=models.PositiveIntegerField(),
+        )
+
+    def annotate_position(self, queryset: Optional[QuerySet] = None) -> QuerySet:
+        """annotates items with sibling_position (starting from 1) and sibling_count,
+        used by get_position instead of querying siblings of each item.
+        Correlated subqueries are used, so that positions are counted among all
+        siblings even when queryset is filtered
+
+        Args:
+            queryset (Optional[QuerySet]): items to annotate, all items by default
+        """
+        if queryset is None:
+            queryset = self.all()
+        siblings = (
+            self.filter(parent=OuterRef("parent"))
+            .order_by()
+            .values("parent")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+        return queryset.annotate(
+            sibling_position=Subquery(siblings.filter(lft__lte=OuterRef("lft"))),
+            sibling_count=Subquery(siblings),
+        )
+
+    @_tree_mutation
+    def rebalance(self, tree_id: Optional[int] = None, batch_size: int = 1000):
+        """renumbers lft and rgt of nodes of given tree, or of all trees,
+        keeping their order, so that neighbouring values differ by SPACING setting"""
+        spacing = conf.get("SPACING")
+        items = self.all() if tree_id is None else self.filter(tree_id=tree_id)
+        _lock_trees(*items.values_list("tree_id", flat=True).distinct())
+        counter = 0
+        current_tree = None
+        # open nodes as [id, old rgt, new lft, old lft and rgt]
+        stack = []
+        changed = []
+
+        def close_node():
+            nonlocal counter
+            id, _, new_lft, old_values = stack.pop()
+            counter += spacing
+            if old_values != (new_lft, counter):
+                changed.append(MenuItem(id=id, lft=new_lft, rgt=counter))
+
+        values = items.order_by("tree_id", "lft").values_list(
+            "tree_id", "id", "lft", "rgt"
+        )
+        for tree, id, lft, rgt in values:
+            if tree != current_tree:
+                while stack:
+                    close_node()
+                current_tree = tree
+                counter = 0
+            while stack and stack[-1][1] < lft:
+                close_node()
+            counter += spacing
+            stack.append([id, rgt, counter, (lft, rgt)])
+        while stack:
+            close_node()
+
+        self.bulk_update(changed, ["lft", "rgt"], batch_size=batch_size)
+        _bump_tree_version()
+
+    @_tree_mutation
+    def reorder_children(
+        self, parent: Union[int, "MenuItem"], ordered_ids: Sequence[int]
+    ):
+        """puts children of parent, with their subtrees, in given order by one
+        update of rows within the range of the children. Gaps between siblings
+        stay at their places, so numbering outside of the range does not change
+
+        Args:
+            parent (Union[int, MenuItem]): parent item or its id
+            ordered_ids (Sequence[int]): ids of all children in new order
+
+        Raises:
+            ValueError: if ordered_ids are not the ids of all children
+        """
+        parent_id = parent.pk if isinstance(parent, MenuItem) else parent
+        locked = set()
+        tree_id = self.values_list("tree_id", flat=True).get(id=parent_id)
+        # parent may be moved to another tree until its tree is locked
+        while tree_id not in locked:
+            _lock_trees(tree_id)
+            locked.add(tree_id)
+            children = list(
+                self.filter(parent=parent_id)
+                .order_by("lft")
+                .values_list("id", "tree_id", "lft", "rgt")
+            )
+            tree_id = children[0][1] if children else tree_id
+
+        ranges = {id: (lft, rgt) for id, _, lft, rgt in children}
+        if len(ordered_ids) != len(ranges) or set(ordered_ids) != ranges.keys():
+            raise ValueError(
+                f"Ids {list(ordered_ids)} are not children of item {parent_id}"
+            )
+
+        # free numbers after each position
+        gaps = [
+            next_lft - rgt - 1
+            for (_, _, _, rgt), (_, _, next_lft, _) in zip(children, children[1:])
+        ] + [0]
+        lft_whens = []
+        rgt_whens = []
+        counter = children[0][2] if children else 0
+        for id, gap in zip(ordered_ids, gaps):
+            lft, rgt = ranges[id]
+            shift = counter - lft
+            if shift:
+                # rgt is matched by its own old value, as some databases
+                # evaluate assignments with already updated lft
+                lft_whens.append(When(lft__range=(lft, rgt), then=F("lft") + shift))
+                rgt_whens.append(When(rgt__range=(lft, rgt), then=F("rgt") + shift))
+            counter += rgt - lft + 1 + gap
+        if not lft_whens:
+            return
+
+        field = models.PositiveIntegerField()
+        self.filter(
+            tree_id=tree_id, lft__range=(children[0][2], children[-1][3])
+        ).update(
+            lft=Case(*lft_whens, default=F("lft"), output_field=field),
+            rgt=Case(*rgt_whens, default=F("rgt"), output_field=field),
+        )
+        _bump_tree_version()
+
+    def check_tree(self, tree_id: Optional[int] = None) -> List[str]:
+        """validates nested set of given tree, or of all trees, in one scan
+        ordered by lft. Values must be increasing without overlapping, and without
+        gaps unless SPACING setting leaves them, each node must have lft < rgt,
+        lie within its parent and trees must have a single root
+
+        Args:
+            tree_id (Optional[int]): tree to check, all trees by default
+
+        Returns:
+            List[str]: descriptions of found problems, empty for valid trees
+        """
+        gapped = _is_gapped()
+        items = self.all() if tree_id is None else self.filter(tree_id=tree_id)
+        problems = []
+        current_tree = None
+        # open nodes as (id, rgt) and last seen lft or rgt value
+        stack = []
+        last = 0
+
+        def check_value(id: int, value: int):
+            nonlocal last
+            if value <= last:
+                problems.append(f"Item {id}: {value} overlaps previous value {last}")
+            elif not gapped and value != last + 1:
+                problems.append(f"Item {id}: gap between {last} and {value}")
+            last = value
+
+        values = items.order_by("tree_id", "lft").values_list(
+            "tree_id", "id", "lft", "rgt", "parent_id"
+        )
+        for tree, id, lft, rgt, parent_id in values.iterator(chunk_size=2000):
+            if tree != current_tree:
+                while stack:
+                    check_value(*stack.pop())
+                current_tree = tree
+                last = 0
+            if lft >= rgt:
+                problems.append(f"Item {id}: lft {lft} is not less than rgt {rgt}")
+                continue
+            while stack and stack[-1][1] < lft:
+                check_value(*stack.pop())
+            if stack and rgt > stack[-1][1]:
+                problems.append(f"Item {id}: overlaps item {stack[-1][0]}")
+            expected_parent = stack[-1][0] if stack else None
+            if not stack and last and parent_id is None:
+                problems.append(f"Item {id}: second root of tree {tree}")
+            elif parent_id != expected_parent:
+                problems.append(
+                    f"Item {id}: not contained in its parent {parent_id}"
+                    if parent_id is not None
+                    else f"Item {id}: root inside item {expected_parent}"
+                )
+            check_value(id, lft)
+            stack.append((id, rgt))
+        while stack:
+            check_value(*stack.pop())
+        return problems
+
+    @_tree_mutation
+    def rebuild(self, batch_size: int = 1000) -> int:
+        """restores nested sets of all trees from parent links, keeping current
+        order of siblings and tree_id of roots. Values are computed in a single
+        pass, together with depth and path, and only changed items are updated
+
+        Args:
+            batch_size (int): number of items updated by one query
+
+        Returns:
+            int: number of updated items
+        """
+        spacing = conf.get("SPACING")
+        _lock_trees(0, *self.values_list("tree_id", flat=True).distinct())
+        rows = {}
+        # children by parent id, in current order
+        children: Dict[Optional[int], List[int]] = {}
+        values = self.order_by("tree_id", "lft").values_list(
+            "id", "parent_id", "tree_id", "lft", "rgt", "depth", "path", "slug"
+        )
+        for row in values.iterator(chunk_size=2000):
+            rows[row[0]] = row
+            children.setdefault(row[1], []).append(row[0])
+
+        changed = []
+        used_tree_ids = set()
+        next_tree_id = max((row[2] for row in rows.values()), default=0) + 1
+        for root_id in children.get(None, ()):
+            tree_id = rows[root_id][2]
+            if tree_id in used_tree_ids:
+                tree_id = next_tree_id
+                next_tree_id += 1
+            used_tree_ids.add(tree_id)
+            counter = spacing
+            slug = rows[root_id][7]
+            # open nodes as [id, lft, depth, path, iterator over children]
+            stack = [[root_id, counter, 0, slug, iter(children.get(root_id, ()))]]
+            while stack:
+                id, lft, depth, path, pending = stack[-1]
+                child_id = next(pending, None)
+                counter += spacing
+                if child_id is None:
+                    stack.pop()
+                    values = (tree_id, lft, counter, depth, path)
+                    if rows.pop(id)[2:7] != values:
+                        changed.append(
+                            MenuItem(
+                                id=id,
+                                tree_id=tree_id,
+                                lft=lft,
+                                rgt=counter,
+                                depth=depth,
+                                path=path,
+                            )
+                        )
+                    continue
+                child_path = f"{path}/{rows[child_id][7]}"
+                stack.append(
+                    [
+                        child_id,
+                        counter,
+                        depth + 1,
+                        child_path,
+                        iter(children.get(child_id, ())),
+                    ]
+                )
+
+        if rows:
+            # items left are not reachable from any root
+            raise ValueError(f"Items {sorted(rows)} have cyclic parent links")
+        self.bulk_update(
+            changed,
+            ["tree_id", "lft", "rgt", "depth", "path"],
+            batch_size=batch_size,
+        )
+        _bump_tree_version()
+        return len(changed)
+
+
+class TreeLock(models.Model):
+    """row lock serializing structural changes of a menu tree, id is tree_id"""
+
+    id = models.PositiveIntegerField(primary_key=True)
+    counter = models.PositiveBigIntegerField(default=0)
+
+
+class TreeVersion(models.Model):
+    """single row with version of all trees, changed in transaction of every
+    tree change, and time of the change. Used with process-local cache
+    backends, shared ones keep the version themselves"""
+
+    version = models.PositiveBigIntegerField()
+    modified = models.DateTimeField()
 
 
 class MenuItem(models.Model):
@@ -39,11 +828,24 @@ class MenuItem(models.Model):
     Do not change lft and rgt values directly unless you know what you are doing"""
 
     _position_updater = None
+    # trees locked by current save or delete
+    _locked_trees = frozenset()
+    # step of save which failed, logged by _tree_mutation unless it is retried
+    _failed_operation = None
     name = models.CharField(max_length=100)
+    # each root with its descendants has separate lft and rgt numbering
+    tree_id = models.PositiveIntegerField(editable=False)
     lft = models.PositiveIntegerField(null=False)
     rgt = models.PositiveIntegerField(null=False)
-    parent = models.ForeignKey("self", null=True, blank=True, on_delete=models.CASCADE)
+    # indexed by menuitem_parent_lft_idx, which starts with parent
+    parent = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.CASCADE, db_index=False
+    )
     slug = models.SlugField(blank=True)
+    # level below root and slugs of ancestors and self joined by "/",
+    # maintained together with lft and rgt
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    path = models.CharField(max_length=1000, blank=True, editable=False, db_index=True)
     objects = MenuManager()
 
     class Meta:
@@ -60,76 +862,171 @@ class MenuItem(models.Model):
                 check=Q(lft__lt=F("rgt")),
                 name="node_okay",
             ),
+            # roots are looked up by slug when drawing menus
+            UniqueConstraint(
+                fields=["slug"],
+                condition=Q(parent__isnull=True),
+                name="unique_root_slug",
+            ),
+        ]
+        indexes = [
+            # tree and subtree range scans ordered by lft, and shifts within tree
+            Index(fields=["tree_id", "lft", "rgt"], name="menuitem_tree_lft_rgt_idx"),
+            # direct children in order, and parent foreign key lookups, as parent
+            # has no index of its own
+            Index(fields=["parent", "lft"], name="menuitem_parent_lft_idx"),
+            # root lookup by name, slug is indexed by SlugField itself
+            Index(fields=["name"], name="menuitem_name_idx"),
         ]
 
     def __str__(self):
         return f"{self.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # parent at load time tells save() whether node has to be moved
+        if "parent_id" in instance.__dict__:
+            instance._loaded_parent_id = instance.parent_id
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        if fields is None or {"parent", "parent_id"} & set(fields):
+            if "parent_id" in self.__dict__:
+                self._loaded_parent_id = self.parent_id
+
+    @_tree_mutation
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        self._locked_trees = set()
+        if self._changes_tree():
+            # tree of new parent, and current tree of existing node
+            reparented = self.parent_id != self.__dict__.get("_loaded_parent_id")
+            self._ensure_locked(
+                self.parent.tree_id if self.parent_id and reparented else None,
+                self.tree_id if self.id else None,
+            )
 
         if not self.id:  # create
             if self.parent:  # new node
                 try:
                     self._create_new_child_node()
-                except Exception as err:
-                    print("Error when creating new child node:", err)
+                except Exception:
+                    self._failed_operation = "creating new child node"
                     raise
                 finally:
                     self._position_updater = None
             else:  # new root
                 try:
-                    boundary = MenuItem.objects.aggregate(Max("rgt"))["rgt__max"] or 0
-                    self.lft = boundary + 1
-                    self.rgt = boundary + 2
-                except Exception as err:
-                    print("Error when creating new root node:", err)
+                    spacing = conf.get("SPACING")
+                    self.tree_id = _next_tree_id()
+                    self.lft = spacing
+                    self.rgt = 2 * spacing
+                    self.depth = 0
+                    self.path = self.slug
+                except Exception:
+                    self._failed_operation = "creating new root node"
                     raise
                 finally:
                     self._position_updater = None
         else:  # update
-            old_obj = MenuItem.objects.get(id=self.id)
-            old_pos = old_obj.get_position()
-            # move node under new parent if changed
-            if (
-                self.parent_id != old_obj.parent_id
-                or old_pos
-                and self._position_updater
-                and old_pos[0] != self._position_updater
-            ):
+            old_parent_id = self.__dict__.get("_loaded_parent_id", _NOT_LOADED)
+            if old_parent_id is _NOT_LOADED:
+                old_parent_id = MenuItem.objects.values_list(
+                    "parent_id", flat=True
+                ).get(id=self.id)
+            moved = self.parent_id != old_parent_id
+            # move node under new parent or among siblings if changed
+            if moved or self._position_updater is not None and self._is_reordered():
                 try:
                     self._update_node_position()
-                except Exception as err:
-                    operation = (
+                    # positions annotated by annotate_position are outdated
+                    self.__dict__.pop("sibling_position", None)
+                    self.__dict__.pop("sibling_count", None)
+                except Exception:
+                    self._failed_operation = (
                         "moving under new parent"
-                        if self.parent_id != old_obj.parent_id
+                        if moved
                         else "changing order amoung siblings"
                     )
-                    print(f"Error when {operation}", err)
                     raise
                 finally:
                     self._position_updater = None
 
+            elif self.path.rpartition("/")[2] != self.slug:
+                self._update_descendants_path()
+
+            # tree_id, lft, rgt, depth and path are updated by tree queries under
+            # the lock, saving them from instance would overwrite changes made
+            # since the instance was loaded. So is parent, unless node was moved
+            # by this save
+            if "update_fields" not in kwargs:
+                tree_fields = ("tree_id", "lft", "rgt", "depth", "path")
+                if not moved:
+                    tree_fields += ("parent",)
+                kwargs["update_fields"] = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name not in tree_fields
+                ]
+
         self._position_updater = None
-        return super().save(*args, **kwargs)
+        result = super().save(*args, **kwargs)
+        self._loaded_parent_id = self.parent_id
+        _bump_tree_version()
+        return result
+
+    def _changes_tree(self) -> bool:
+        """checks if saving changes numbering or paths of other nodes, so that
+        tree lock has to be taken, while plain edits do not wait for it"""
+        return (
+            not self.id
+            or self._position_updater is not None
+            or self.parent_id != self.__dict__.get("_loaded_parent_id", _NOT_LOADED)
+            or self.path.rpartition("/")[2] != self.slug
+        )
 
+    def _ensure_locked(self, *tree_ids: Optional[int]) -> bool:
+        """locks given trees not locked by current save or delete yet. Returns
+        True if any lock was taken, as values read before it may be outdated"""
+        missing = {tree_id for tree_id in tree_ids if tree_id is not None}
+        missing -= self._locked_trees
+        if missing:
+            _lock_trees(*missing)
+            self._locked_trees = self._locked_trees | missing
+        return bool(missing)
+
+    @_tree_mutation
     def delete(self, *args, **kwargs):
-        width = self.rgt - self.lft + 1
-        MenuItem.objects.filter(lft__range=(self.lft, self.rgt)).delete()
-        MenuItem.objects.filter(lft__gt=self.rgt).update(lft=F("lft") - width)
-        MenuItem.objects.filter(rgt__gt=self.rgt).update(rgt=F("rgt") - width)
+        self._locked_trees = set()
+        self._ensure_locked(self.tree_id)
+        # numbering may have changed since instance was loaded
+        while True:
+            tree_id, lft, rgt = MenuItem.objects.values_list(
+                "tree_id", "lft", "rgt"
+            ).get(id=self.id)
+            if not self._ensure_locked(tree_id):
+                break
+        MenuItem.objects.filter(tree_id=tree_id, lft__range=(lft, rgt)).delete()
+        self._close_gap(tree_id, lft, rgt)
 
-        return super().delete(*args, **kwargs)
+        result = super().delete(*args, **kwargs)
+        _bump_tree_version()
+        return result
 
     def get_position(self) -> Optional[Tuple[int, int]]:
         """returns human-readable position (starting from 1) of this node among siblings
         and total siblings count, or none if root node"""
-        if self.parent:
+        if self.parent_id and hasattr(self, "sibling_position"):
+            return self.sibling_position, self.sibling_count
+
+        if self.parent_id:
             siblings = list(
-                MenuItem.objects.get_descendants(self.parent_id, True).values_list(
-                    "id", flat=True
-                )
+                MenuItem.objects.filter(parent_id=self.parent_id)
+                .order_by("lft")
+                .values_list("id", flat=True)
             )
             # increase position by 1 to make tuple human-readable
             position = siblings.index(self.id) + 1
@@ -137,6 +1034,17 @@ class MenuItem(models.Model):
 
             return position, total
 
+    def _is_reordered(self) -> bool:
+        """checks if position set by set_new_position differs from current one"""
+        position = self.get_position()
+        if not position:
+            return False
+        index, total = position[0] - 1, position[1]
+        target = self._position_updater
+        if target == -1 or target >= total:
+            target = total - 1
+        return target != index
+
     def set_new_position(self, index: int):
         """Sets 0-based node position amoung siblings. Position is checked upon .save() call.
         If parent remains the same, changes order amoung siblings,
@@ -154,6 +1062,13 @@ class MenuItem(models.Model):
         self._position_updater = index
 
     def _create_new_child_node(self):
+        # numbering may have changed since parent was loaded
+        self.parent.refresh_from_db(fields=["tree_id", "lft", "rgt", "depth", "path"])
+        if self._ensure_locked(self.parent.tree_id):
+            return self._create_new_child_node()
+        self.tree_id = self.parent.tree_id
+        self.depth = self.parent.depth + 1
+        self.path = f"{self.parent.path}/{self.slug}"
         descendants = MenuItem.objects.get_descendants(self.parent_id, direct_only=True)
 
         if (
@@ -169,60 +1084,206 @@ class MenuItem(models.Model):
         else:
             boundary = descendants[self._position_updater - 1].rgt
 
-        MenuItem.objects.filter(rgt__gt=boundary).update(rgt=F("rgt") + 2)
-        MenuItem.objects.filter(lft__gt=boundary).update(lft=F("lft") + 2)
+        if _is_gapped():
+            if self._position_updater < len(descendants):
+                next_boundary = descendants[self._position_updater].lft
+            else:
+                next_boundary = self.parent.rgt
+
+            if next_boundary - boundary > 2:
+                self.lft, self.rgt = _allocate(boundary, next_boundary, 2)
+                return
+
+            # gap is exhausted, renumber and try again
+            MenuItem.objects.rebalance(self.tree_id)
+            return self._create_new_child_node()
+
+        tree = MenuItem.objects.filter(tree_id=self.tree_id)
+        tree.filter(rgt__gt=boundary).update(rgt=F("rgt") + 2)
+        tree.filter(lft__gt=boundary).update(lft=F("lft") + 2)
 
         self.lft = boundary + 1
         self.rgt = boundary + 2
 
     def _update_node_position(self):
-        tree_ids = list(MenuItem.objects.get_tree(self.id).values_list("id", flat=True))
-
-        # update previous obj place
-        offset = self.rgt - self.lft + 1
-        source_boundary = self.lft
+        """moves node with all descendants under self.parent at position set by
+        set_new_position. Within a tree affected ranges are shifted by single
+        update, moving to another tree opens a gap there, moves node tree and
+        closes the gap left behind"""
+        tree_id, lft, rgt, depth, path = MenuItem.objects.values_list(
+            "tree_id", "lft", "rgt", "depth", "path"
+        ).get(id=self.id)
+        if self._ensure_locked(tree_id):
+            return self._update_node_position()
+        width = rgt - lft + 1
 
-        MenuItem.objects.filter(lft__gt=source_boundary).exclude(
-            id__in=tree_ids
-        ).update(lft=F("lft") - offset)
-
-        MenuItem.objects.filter(rgt__gt=source_boundary).exclude(
-            id__in=tree_ids
-        ).update(rgt=F("rgt") - offset)
+        if self.parent_id:
+            parent = MenuItem.objects.get(id=self.parent_id)
+            if self._ensure_locked(parent.tree_id):
+                return self._update_node_position()
+            if parent.tree_id == tree_id and lft <= parent.lft <= rgt:
+                raise ValueError("node can not be moved under itself or its descendant")
+            self.depth = parent.depth + 1
+            self.path = f"{parent.path}/{self.slug}"
+        else:
+            self.depth = 0
+            self.path = self.slug
+        tree_values = self._tree_values((lft, rgt), depth, path)
+        node_tree = MenuItem.objects.filter(tree_id=tree_id, lft__range=(lft, rgt))
 
-        # update new obj place
+        if not self.parent_id:  # becomes root of a new tree
+            new_tree_id = _next_tree_id()
+            shift = conf.get("SPACING") - lft
+            node_tree.update(
+                **tree_values,
+                tree_id=new_tree_id,
+                lft=F("lft") + shift,
+                rgt=F("rgt") + shift,
+            )
+            self._close_gap(tree_id, lft, rgt)
+            self.tree_id = new_tree_id
+            self.lft = lft + shift
+            self.rgt = rgt + shift
+            return
 
-        target_descendants = MenuItem.objects.get_descendants(
-            self.parent_id, direct_only=True
+        target_siblings = list(
+            MenuItem.objects.filter(parent_id=self.parent_id)
+            .exclude(id=self.id)
+            .order_by("lft")
+            .values_list("lft", "rgt")
         )
-
         if (
             self._position_updater == None
             or self._position_updater == -1
-            or self._position_updater > len(target_descendants)
+            or self._position_updater > len(target_siblings)
         ):
-            self._position_updater = len(target_descendants)
+            self._position_updater = len(target_siblings)
 
         # target has no children or insert as first child
-        if self._position_updater == 0 or not target_descendants:
-            target_boundary = self.parent.lft
+        if self._position_updater == 0:
+            target_boundary = parent.lft
         else:
-            target_boundary = target_descendants[self._position_updater - 1].rgt
+            target_boundary = target_siblings[self._position_updater - 1][1]
 
-        MenuItem.objects.filter(rgt__gt=target_boundary).exclude(
-            id__in=tree_ids
-        ).update(rgt=F("rgt") + offset)
+        if self._position_updater < len(target_siblings):
+            next_boundary = target_siblings[self._position_updater][0]
+        else:
+            next_boundary = parent.rgt
 
-        MenuItem.objects.filter(lft__gt=target_boundary).exclude(
-            id__in=tree_ids
-        ).update(lft=F("lft") + offset)
+        # with gapped numbering node tree may fit into a free gap as is
+        if _is_gapped() and next_boundary - target_boundary > width:
+            new_lft, _ = _allocate(target_boundary, next_boundary, width)
+            shift = new_lft - lft
+            node_tree.update(
+                **tree_values,
+                tree_id=parent.tree_id,
+                lft=F("lft") + shift,
+                rgt=F("rgt") + shift,
+            )
+            self.tree_id = parent.tree_id
+            self.lft = lft + shift
+            self.rgt = rgt + shift
+            return
 
-        # update inserted tree
-        shift = target_boundary - source_boundary + 1
+        if parent.tree_id != tree_id:
+            target_tree = MenuItem.objects.filter(tree_id=parent.tree_id)
+            target_tree.filter(rgt__gt=target_boundary).update(rgt=F("rgt") + width)
+            target_tree.filter(lft__gt=target_boundary).update(lft=F("lft") + width)
+            shift = target_boundary + 1 - lft
+            node_tree.update(
+                **tree_values,
+                tree_id=parent.tree_id,
+                lft=F("lft") + shift,
+                rgt=F("rgt") + shift,
+            )
+            self._close_gap(tree_id, lft, rgt)
+            self.tree_id = parent.tree_id
+            self.lft = lft + shift
+            self.rgt = rgt + shift
+            return
 
-        MenuItem.objects.filter(id__in=tree_ids).update(
-            lft=F("lft") + shift, rgt=F("rgt") + shift
+        # node tree lands right after target boundary, and nodes between
+        # boundary and node tree move by tree width to the opposite side
+        if target_boundary < lft:
+            shift = target_boundary + 1 - lft
+            between = (target_boundary + 1, lft - 1)
+            offset = width
+        else:
+            shift = target_boundary - rgt
+            between = (rgt + 1, target_boundary)
+            offset = -width
+
+        if not shift:
+            node_tree.update(**tree_values)
+        else:
+            affected = (min(lft, between[0]), max(rgt, between[1]))
+            MenuItem.objects.filter(
+                Q(lft__range=affected) | Q(rgt__range=affected), tree_id=tree_id
+            ).update(
+                **tree_values,
+                lft=self._shift_ranges("lft", (lft, rgt), shift, between, offset),
+                rgt=self._shift_ranges("rgt", (lft, rgt), shift, between, offset),
+            )
+
+        self.lft = lft + shift
+        self.rgt = rgt + shift
+
+    def _tree_values(
+        self, tree: Tuple[int, int], old_depth: int, old_path: str
+    ) -> Dict[str, Case]:
+        """update expressions moving depth and path of node tree from old values
+        to values of this node, used before lft and rgt, as some databases
+        evaluate assignments with already updated values"""
+        in_tree = Q(lft__range=tree)
+        return {
+            "depth": Case(
+                When(in_tree, then=F("depth") + (self.depth - old_depth)),
+                default=F("depth"),
+                output_field=models.PositiveIntegerField(),
+            ),
+            "path": Case(
+                When(
+                    in_tree,
+                    then=Concat(Value(self.path), Substr("path", len(old_path) + 1)),
+                ),
+                default=F("path"),
+                output_field=models.CharField(),
+            ),
+        }
+
+    def _update_descendants_path(self):
+        tree_id, lft, rgt, path = MenuItem.objects.values_list(
+            "tree_id", "lft", "rgt", "path"
+        ).get(id=self.id)
+        if self._ensure_locked(tree_id):
+            return self._update_descendants_path()
+        self.path = f"{path.rpartition('/')[0]}/{self.slug}".lstrip("/")
+        MenuItem.objects.filter(tree_id=tree_id, lft__range=(lft, rgt)).update(
+            path=Concat(Value(self.path), Substr("path", len(path) + 1))
         )
 
-        self.lft += shift
-        self.rgt += shift
+    @staticmethod
+    def _close_gap(tree_id: int, lft: int, rgt: int):
+        """shifts numbering of tree after removed range back by its width,
+        with gapped numbering freed range stays as a gap"""
+        if _is_gapped():
+            return
+        width = rgt - lft + 1
+        tree = MenuItem.objects.filter(tree_id=tree_id)
+        tree.filter(lft__gt=rgt).update(lft=F("lft") - width)
+        tree.filter(rgt__gt=rgt).update(rgt=F("rgt") - width)
+
+    @staticmethod
+    def _shift_ranges(
+        field: str,
+        tree: Tuple[int, int],
+        shift: int,
+        between: Tuple[int, int],
+        offset: int,
+    ) -> Case:
+        return Case(
+            When(**{f"{field}__range": tree}, then=F(field) + shift),
+            When(**{f"{field}__range": between}, then=F(field) + offset),
+            default=F(field),
+            output_field=models.PositiveIntegerField(),
+        )
@@ -0,0 +1,347 @@
+"""Compact binary snapshot of all menu trees, shared by worker processes.
+
+Snapshot file holds items of all trees ordered by tree_id and lft as columns of
+fixed size integers, with names and slugs in a sorted table of unique strings.
+Workers map the file into memory, so its pages are shared between them, and
+read rows straight from the mapping without creating model instances.
+
+Snapshot is labelled by tree version. It is written by a background thread
+after commit of tree changes, several changes committed meanwhile being written
+once, and by write_snapshot command, to a new file atomically replacing the old
+one, while workers keep reading their old mapping until they notice the new
+version. Workers finding snapshot outdated read trees from database meanwhile,
+so no request waits for the snapshot to be written.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+from django.apps import apps
+from django.db import connections, transaction
+from menu_maker import cache, conf
+from menu_maker.cache import TreeRow
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MMSNAP01"
+# magic, tree version, number of items, of strings and size of string data
+HEADER = struct.Struct("=8sqqqq")
+# item columns, items are ordered by tree_id and lft. parent and end are item
+# indexes, end being index after the last descendant, name and slug are string
+# indexes, and by_id holds item indexes ordered by id
+ITEM_COLUMNS = (
+    ("id", "q"),
+    ("tree_id", "q"),
+    ("lft", "q"),
+    ("rgt", "q"),
+    ("parent", "i"),
+    ("end", "i"),
+    ("depth", "i"),
+    ("name", "i"),
+    ("slug", "i"),
+    ("by_id", "i"),
+)
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def _file_key(stat: os.stat_result) -> Tuple[int, int, int, int]:
+    """identifies file content, as snapshot is replaced by another file"""
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _file_version(path: str) -> Optional[int]:
+    """returns tree version of snapshot at path, or None if it is not one"""
+    try:
+        with open(path, "rb") as file:
+            header = file.read(HEADER.size)
+    except OSError:
+        return None
+    if len(header) < HEADER.size or header[: len(MAGIC)] != MAGIC:
+        return None
+    return HEADER.unpack(header)[1]
+
+
+def _layout(items: int, strings: int) -> List[Tuple[str, str, int]]:
+    # string columns are offsets of strings in string data, and first item with
+    # the string as name or slug, which is the item drawn by menu of that name
+    return [(name, code, items) for name, code in ITEM_COLUMNS] + [
+        ("offsets", "q", strings + 1),
+        ("first", "i", strings),
+    ]
+
+
+class Snapshot:
+    """read-only memory-mapped snapshot, columns are memoryviews of the file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            self.file_key = _file_key(os.fstat(file.fileno()))
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap.size() < HEADER.size:
+            raise ValueError(f"{path} is not a menu snapshot")
+        magic, self.version, items, strings, data_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a menu snapshot")
+
+        view = memoryview(self._mmap)
+        self.columns: Dict[str, memoryview] = {}
+        offset = HEADER.size
+        for name, code, count in _layout(items, strings):
+            offset = _align(offset)
+            size = count * struct.calcsize(code)
+            self.columns[name] = view[offset : offset + size].cast(code)
+            offset += size
+        self._data = view[offset : offset + data_size]
+
+    def __len__(self) -> int:
+        return len(self.columns["id"])
+
+    def _string(self, index: int) -> str:
+        offsets = self.columns["offsets"]
+        return str(self._data[offsets[index] : offsets[index + 1]], "utf-8")
+
+    def _find(self, key: str) -> int:
+        """returns index of the first item named key or with slug key, or -1"""
+        lo, hi = 0, len(self.columns["first"])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.columns["first"]) and self._string(lo) == key:
+            return self.columns["first"][lo]
+        return -1
+
+    def _find_id(self, id: int) -> int:
+        ids, by_id = self.columns["id"], self.columns["by_id"]
+        lo, hi = 0, len(by_id)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ids[by_id[mid]] < id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(by_id) and ids[by_id[lo]] == id:
+            return by_id[lo]
+        return -1
+
+    def _row(self, index: int) -> TreeRow:
+        columns = self.columns
+        parent = columns["parent"][index]
+        return TreeRow(
+            columns["id"][index],
+            self._string(columns["name"][index]),
+            self._string(columns["slug"][index]),
+            columns["lft"][index],
+            columns["rgt"][index],
+            columns["id"][parent] if parent != -1 else None,
+        )
+
+    def get_tree(self, root: str) -> Optional[Tuple[TreeRow, ...]]:
+        """returns rows of tree by name or slug of its top item, same as
+        MenuItem.objects.get_cached_tree, or None if there is no such item"""
+        index = self._find(str(root))
+        if index == -1:
+            return None
+        return tuple(self._row(i) for i in range(index, self.columns["end"][index]))
+
+    def get_children(self, id: int) -> Optional[List[Tuple[TreeRow, bool]]]:
+        """returns direct children of item with flags whether they have children,
+        or None if there is no such item"""
+        index = self._find_id(id)
+        if index == -1:
+            return None
+        end = self.columns["end"]
+        children = []
+        child = index + 1
+        while child < end[index]:
+            children.append((self._row(child), end[child] > child + 1))
+            child = end[child]
+        return children
+
+
+def write_snapshot(path: str, version: int) -> bool:
+    """writes snapshot of all trees by a single query, replacing file at path
+    only when it is complete. Version has to be read before calling, so that
+    changes made during the query make snapshot outdated. Returns False when
+    another process has written newer version meanwhile, which is kept"""
+    MenuItem = apps.get_model("menu_maker", "MenuItem")
+    columns = {name: array(code) for name, code in ITEM_COLUMNS}
+    names: List[str] = []
+    slugs: List[str] = []
+    index_by_id = {}
+    # indexes of open items, and their tree and rgt
+    stack: List[Tuple[int, int, int]] = []
+
+    values = MenuItem.objects.order_by("tree_id", "lft").values_list(
+        "id", "tree_id", "lft", "rgt", "parent_id", "depth", "name", "slug"
+    )
+    for index, row in enumerate(values.iterator(chunk_size=2000)):
+        id, tree_id, lft, rgt, parent_id, depth, name, slug = row
+        while stack and (stack[-1][1] != tree_id or stack[-1][2] < lft):
+            columns["end"][stack.pop()[0]] = index
+        index_by_id[id] = index
+        for column, value in (
+            ("id", id),
+            ("tree_id", tree_id),
+            ("lft", lft),
+            ("rgt", rgt),
+            ("parent", index_by_id.get(parent_id, -1)),
+            ("end", index + 1),
+            ("depth", depth),
+        ):
+            columns[column].append(value)
+        names.append(name)
+        slugs.append(slug)
+        stack.append((index, tree_id, rgt))
+    while stack:
+        columns["end"][stack.pop()[0]] = len(names)
+
+    strings = sorted(set(names) | set(slugs))
+    string_index = {string: i for i, string in enumerate(strings)}
+    columns["name"] = array("i", (string_index[name] for name in names))
+    columns["slug"] = array("i", (string_index[slug] for slug in slugs))
+    columns["by_id"] = array(
+        "i", sorted(index_by_id.values(), key=columns["id"].__getitem__)
+    )
+    first = array("i", [-1]) * len(strings)
+    for index in range(len(names)):
+        for string in (columns["name"][index], columns["slug"][index]):
+            if first[string] == -1:
+                first[string] = index
+
+    encoded = [string.encode() for string in strings]
+    offsets = array("q", [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    columns["offsets"] = offsets
+    columns["first"] = first
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".menu-snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(
+                HEADER.pack(MAGIC, version, len(names), len(strings), offsets[-1])
+            )
+            for name, _, _ in _layout(len(names), len(strings)):
+                file.write(b"\0" * (_align(file.tell()) - file.tell()))
+                columns[name].tofile(file)
+            file.write(b"".join(encoded))
+            file.flush()
+            os.fsync(file.fileno())
+        # workers may run as other user than writer, mkstemp makes file private
+        os.chmod(temp_path, 0o644)
+        current = _file_version(path)
+        if current is not None and current > version:
+            os.remove(temp_path)
+            return False
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return True
+
+
+# snapshot mapped by this process
+_snapshot: Optional[Snapshot] = None
+# path and file key of file found not to be a snapshot
+_invalid_file: Optional[Tuple[str, Tuple[int, int, int, int]]] = None
+
+
+def get_snapshot(version: int) -> Optional[Snapshot]:
+    """returns snapshot of given tree version from SNAPSHOT_PATH setting, mapping
+    the file again when another process has replaced it. Returns None when
+    snapshot is disabled, missing, invalid or outdated. File found outdated or
+    invalid is not read again until it is replaced"""
+    global _snapshot, _invalid_file
+    path = conf.get("SNAPSHOT_PATH")
+    if not path:
+        return None
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.path == path and snapshot.version == version:
+        return snapshot
+
+    try:
+        key = _file_key(os.stat(path))
+    except OSError:
+        return None
+    if snapshot is not None and (snapshot.path, snapshot.file_key) == (path, key):
+        # mapped file is still there, and holds other version
+        return None
+    if _invalid_file == (path, key):
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError):
+        _invalid_file = (path, key)
+        return None
+    _snapshot = snapshot
+    return snapshot if snapshot.version == version else None
+
+
+def update_snapshot() -> bool:
+    """writes snapshot of current tree version to SNAPSHOT_PATH setting, unless
+    the file already holds it or a newer one. Returns True if snapshot was
+    written"""
+    path = conf.get("SNAPSHOT_PATH")
+    if not path:
+        return False
+    version = cache.get_tree_version()
+    if get_snapshot(version) is not None:
+        return False
+    return write_snapshot(path, version)
+
+
+# whether snapshot has to be written again, and thread writing it
+_pending = False
+_writer: Optional[threading.Thread] = None
+_writer_lock = threading.Lock()
+
+
+def _write_pending():
+    """writes snapshot until no change is committed during writing"""
+    global _pending, _writer
+    try:
+        while True:
+            with _writer_lock:
+                if not _pending:
+                    _writer = None
+                    return
+                _pending = False
+            # changes are committed already, outdated snapshot only makes
+            # workers read trees from database
+            try:
+                update_snapshot()
+            except Exception:
+                logger.exception("Error when writing menu snapshot")
+    finally:
+        connections.close_all()
+
+
+def _request_update():
+    global _pending, _writer
+    with _writer_lock:
+        _pending = True
+        if _writer is None:
+            _writer = threading.Thread(
+                target=_write_pending, name="menu-snapshot-writer", daemon=True
+            )
+            _writer.start()
+
+
+def schedule_update():
+    """writes snapshot in background when current transaction is committed, so
+    that it holds committed trees of the new version and the change does not
+    wait for it"""
+    if conf.get("SNAPSHOT_PATH"):
+        transaction.on_commit(_request_update)
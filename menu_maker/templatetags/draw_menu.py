@@ -1,81 +1,423 @@
-from typing import Any, Dict
+import re
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 from django import template
-from django.db.models.query import QuerySet
-from django.http import HttpRequest
-from django.utils.safestring import SafeString
+from django.http import Http404, HttpRequest
+from django.template.loader import render_to_string
+from django.urls import NoReverseMatch, reverse
+from django.utils.safestring import SafeString, mark_safe
+from menu_maker import cache, instrumentation
+from menu_maker.cache import TreeRow
 from menu_maker.models import MenuItem
-from dataclasses import dataclass
+
+ACTIVE_CLASS = " active"
+HIDDEN_CLASS = " submenu-hidden"
+SLOT_PATTERN = re.compile(r"<!--slot:(\d+)-->")
 
 
-@dataclass
 class Node:
-    item: MenuItem
-    is_parent = False
-    hidden = True
-    is_last_child = False
-    is_active = False
-    ul_iterator = None
+    """menu item with rendering flags, computed by _annotate_nodes"""
 
+    __slots__ = (
+        "item",
+        "depth",
+        "parent",
+        "is_parent",
+        "collapsed",
+        "is_last_child",
+        "is_active",
+        "hidden",
+        "close_count",
+        "active_class",
+        "hidden_class",
+    )
 
-register = template.Library()
+    def __init__(self, item: TreeRow, depth: int = 0, parent: int = -1):
+        self.item = item
+        self.depth = depth
+        # index of parent node in annotated list, or -1 for menu root
+        self.parent = parent
+        self.is_parent = False
+        # node has children, which are not drawn
+        self.collapsed = False
+        self.is_last_child = False
+        self.is_active = False
+        self.hidden = True
+        # number of submenus closed right after this node
+        self.close_count = 0
+        self.active_class = ""
+        self.hidden_class = HIDDEN_CLASS
 
+    @property
+    def close_range(self) -> range:
+        return range(self.close_count)
 
-def _tree_to_nodes(menu_items: QuerySet) -> Dict[int, Node]:
-    menu_dict = {}
-    for item in menu_items:
-        menu_dict[item.id] = Node(item)
-    return menu_dict
 
+class MenuFragment(NamedTuple):
+    """menu html pre-rendered without active node. Html is split into parts,
+    where css classes of menu items and submenus are separate slots,
+    so marking active path only needs replacing a few parts"""
+
+    parts: Tuple[str, ...]
+    # node index by slug
+    slugs: Dict[str, int]
+    # parent node index, or -1 for menu root
+    parents: Tuple[int, ...]
+    # part index of menu item class for each node
+    active_slots: Tuple[int, ...]
+    # part index of submenu class for each node, or -1 if node has no children
+    hidden_slots: Tuple[int, ...]
 
-def _annotate_nodes(menu_dict: Dict[int, Node], active_menu: str):
-    if not menu_dict:
-        return
+    def render(self, active_menu: Optional[str]) -> SafeString:
+        index = self.slugs.get(active_menu, -1)
+        if index == -1:
+            return mark_safe("".join(self.parts))
 
-    active_item = None
-    nodes = list(menu_dict.values())
-    for i, node in enumerate(nodes):
-        if node.item.rgt - node.item.lft > 1:
-            node.is_parent = True
+        parts = list(self.parts)
+        parts[self.active_slots[index]] = ACTIVE_CLASS
+        while index != -1:
+            if self.hidden_slots[index] != -1:
+                parts[self.hidden_slots[index]] = ""
+            index = self.parents[index]
+        return mark_safe("".join(parts))
+
+
+register = template.Library()
 
-        if node.item.parent_id:
-            parent = menu_dict.get(node.item.parent_id).item or None
-            if parent and node.item.rgt == parent.rgt - 1:
-                node.is_last_child = True
 
-        if node.item.slug == active_menu:
+def _annotate_nodes(
+    menu_items: Iterable[TreeRow], active_menu: Optional[str] = None
+) -> List[Node]:
+    """annotates lft-ordered menu items in a single pass, keeping a stack
+    of currently open parent nodes
+
+    Args:
+        menu_items (Iterable[TreeRow]): menu root followed by its descendants,
+        ordered by lft
+        active_menu (Optional[str]): slug of active menu item
+
+    Returns:
+        List[Node]: annotated nodes in the same order
+    """
+    nodes: List[Node] = []
+    # indexes of open parent nodes and of their last seen child
+    stack: List[int] = []
+    last_children: List[int] = []
+    active_found = False
+
+    for item in menu_items:
+        if nodes:
+            previous = nodes[-1]
+            if item.lft < previous.item.rgt:
+                previous.is_parent = True
+                stack.append(len(nodes) - 1)
+                last_children.append(-1)
+            else:
+                while stack and nodes[stack[-1]].item.rgt < item.lft:
+                    stack.pop()
+                    nodes[last_children.pop()].is_last_child = True
+                    previous.close_count += 1
+
+        node = Node(item, len(stack), stack[-1] if stack else -1)
+        if stack:
+            last_children[-1] = len(nodes)
+        if not active_found and item.slug == active_menu:
+            active_found = True
             node.is_active = True
             node.hidden = False
-            active_item = node.item
+            for index in stack:
+                nodes[index].hidden = False
+        nodes.append(node)
+
+    if nodes:
+        nodes[-1].close_count += len(stack)
+        for index in last_children:
+            nodes[index].is_last_child = True
+
+    return nodes
+
+
+def _build_fragment(
+    menu_name: str, rows: Iterable[TreeRow], parent_ids: FrozenSet[int] = frozenset()
+) -> MenuFragment:
+    with instrumentation.timer("annotate_time"):
+        nodes_list = _annotate_nodes(rows)
+    for node in nodes_list:
+        node.collapsed = not node.is_parent and node.item.id in parent_ids
+
+    # render slot markers instead of css classes, then split html by them
+    for i, node in enumerate(nodes_list):
+        node.active_class = mark_safe(f"<!--slot:{2 * i}-->")
+        node.hidden_class = mark_safe(f"<!--slot:{2 * i + 1}-->")
+
+    with instrumentation.timer("render_time"):
+        html = render_to_string(
+            "menu_maker/menu.html", {"menu_nodes": nodes_list, "menu_name": menu_name}
+        )
+
+    parts = []
+    slot_parts = {}
+    for i, part in enumerate(SLOT_PATTERN.split(html)):
+        if i % 2:
+            slot_parts[int(part)] = len(parts)
+            part = "" if int(part) % 2 == 0 else HIDDEN_CLASS
+        parts.append(part)
+
+    return MenuFragment(
+        parts=tuple(parts),
+        slugs={node.item.slug: i for i, node in reversed(list(enumerate(nodes_list)))},
+        parents=tuple(node.parent for node in nodes_list),
+        active_slots=tuple(slot_parts[2 * i] for i in range(len(nodes_list))),
+        hidden_slots=tuple(
+            slot_parts.get(2 * i + 1, -1) for i in range(len(nodes_list))
+        ),
+    )
+
+
+def _note_fragments(
+    timing: instrumentation.MenuTiming,
+    fragments: Dict[str, MenuFragment],
+    missing: List[str],
+):
+    timing.cache_hit = not missing
+    timing.nodes = sum(len(fragment.parents) for fragment in fragments.values())
+
+
+def get_menu_fragments(menu_names: Iterable[str]) -> Dict[str, MenuFragment]:
+    """returns pre-rendered menus, rendering each once per tree version.
+    Trees of all menus missing from cache are loaded together"""
+    menu_names = [str(name) for name in menu_names]
+    with instrumentation.measure(",".join(menu_names)) as timing, cache.version_scope():
+        version = cache.get_tree_version()
+        fragments = cache.get_many("fragment", menu_names, version)
+        missing = [name for name in menu_names if name not in fragments]
+        if missing:
+            trees = MenuItem.objects.get_cached_trees(missing)
+            built = {name: _build_fragment(name, rows) for name, rows in trees.items()}
+            cache.set_many("fragment", built, version)
+            fragments.update(built)
+        _note_fragments(timing, fragments, missing)
+    return fragments
 
-        if node.is_last_child and not node.is_parent:
-            if i < len(nodes) - 2:
-                next_lft = nodes[i + 1].item.lft
-                ul_n = next_lft - node.item.rgt - 1
-            else:
-                next_lft = nodes[0].item.rgt
-                ul_n = next_lft - node.item.rgt
 
-            node.ul_iterator = list(range(ul_n))
+async def aget_menu_fragments(menu_names: Iterable[str]) -> Dict[str, MenuFragment]:
+    """asynchronous get_menu_fragments, used by MenuRegistry.aload in async
+    views, so that draw_menu needs no queries"""
+    menu_names = [str(name) for name in menu_names]
+    with instrumentation.measure(",".join(menu_names)) as timing, cache.version_scope():
+        version = await cache.aget_tree_version()
+        fragments = await cache.aget_many("fragment", menu_names, version)
+        missing = [name for name in menu_names if name not in fragments]
+        if missing:
+            trees = await MenuItem.objects.aget_cached_trees(missing)
+            built = {name: _build_fragment(name, rows) for name, rows in trees.items()}
+            await cache.aset_many("fragment", built, version)
+            fragments.update(built)
+        _note_fragments(timing, fragments, missing)
+    return fragments
 
-    if not active_item:
-        return
 
-    ancestor = menu_dict.get(active_item.parent_id) or None
-    while ancestor:
-        ancestor.hidden = False
-        ancestor = menu_dict.get(ancestor.item.parent_id) or None
+def warm_menus(batch_size: int = 100) -> List[str]:
+    """builds trees and fragments of all root menus missing from cache, loading
+    batch_size trees by a pair of queries, so that first requests after deploy or
+    cache flush are served from cache. Menus are cached by root name, as drawn by
+    {% draw_menu "Name" %}. Roots without url named by lowercase menu name can
+    not be drawn and are skipped
 
+    Returns:
+        List[str]: names of drawable menus, which are now cached
+    """
+    names = []
+    roots = MenuItem.objects.filter(parent=None).order_by("tree_id")
+    for name, slug in roots.values_list("name", "slug"):
+        try:
+            reverse(name.lower(), args=[slug])
+        except NoReverseMatch:
+            continue
+        names.append(name)
 
-@register.inclusion_tag("menu_maker/menu.html", takes_context=True)
-def draw_menu(context: Dict[str, Any], menu_name: SafeString):
-    request: HttpRequest = context["request"]
-    active_menu = request.resolver_match.kwargs.get("slug") or None
-    menu_nodes = _tree_to_nodes(MenuItem.objects.get_tree(str(menu_name)))
+    with cache.version_scope():
+        for start in range(0, len(names), batch_size):
+            get_menu_fragments(names[start : start + batch_size])
+    return names
 
-    _annotate_nodes(menu_nodes, active_menu)
-    nodes_list = sorted(list(menu_nodes.values()), key=lambda x: x.item.lft)
 
-    return {
-        "menu_nodes": nodes_list,
-        "menu_name": menu_name,
-    }
+def get_menu_fragment(menu_name: str) -> MenuFragment:
+    fragment = get_menu_fragments([menu_name]).get(str(menu_name))
+    if fragment is None:
+        raise Http404("No MenuItem matches the given query.")
+    return fragment
+
+
+def get_expanded_fragment(
+    menu_name: str, active_menu: Optional[str], depth: int
+) -> MenuFragment:
+    """returns pre-rendered menu holding only items visible with given active
+    item and depth limit, rendering it once per tree version"""
+    key = f"{menu_name}:{depth}:{active_menu or ''}"
+    version = cache.get_tree_version()
+    fragment = cache.get_many("fragment", [key], version).get(key)
+    timing = instrumentation.current()
+    if timing is not None:
+        timing.cache_hit = fragment is not None
+    if fragment is None:
+        rows = []
+        parent_ids = set()
+        items = MenuItem.objects.get_expanded_tree(menu_name, active_menu, depth)
+        for *values, has_children in items.values_list(
+            *TreeRow._fields, "has_children"
+        ):
+            rows.append(TreeRow(*values))
+            if has_children:
+                parent_ids.add(rows[-1].id)
+        fragment = _build_fragment(menu_name, rows, frozenset(parent_ids))
+        cache.set_many("fragment", {key: fragment}, version)
+    return fragment
+
+
+class MenuRegistry:
+    """menus of one request, shared by the view, load_menus, draw_menu and
+    menu_breadcrumbs. Active item slug is resolved from url once, and each menu
+    is loaded at most once. Tree rows are loaded only for the menu holding active
+    item, when it or breadcrumbs are asked for, so pages drawing menus only
+    read their fragments"""
+
+    def __init__(self, active_slug: Optional[str] = None):
+        self.active_slug = active_slug
+        self.trees: Dict[str, Tuple[TreeRow, ...]] = {}
+        self.fragments: Dict[str, MenuFragment] = {}
+
+    @classmethod
+    def from_request(cls, request: HttpRequest) -> "MenuRegistry":
+        match = request.resolver_match
+        return cls(match.kwargs.get("slug") or None if match else None)
+
+    def _missing(self, menu_names: Iterable[str]) -> List[str]:
+        names = dict.fromkeys(str(name) for name in menu_names)
+        return [name for name in names if name not in self.fragments]
+
+    def load(self, menu_names: Iterable[str]):
+        """loads menus not loaded yet"""
+        missing = self._missing(menu_names)
+        if missing:
+            self.fragments.update(get_menu_fragments(missing))
+
+    async def aload(self, menu_names: Iterable[str]):
+        """asynchronous load for async views"""
+        missing = self._missing(menu_names)
+        if missing:
+            self.fragments.update(await aget_menu_fragments(missing))
+
+    def get_fragment(self, menu_name: str) -> MenuFragment:
+        self.load([menu_name])
+        fragment = self.fragments.get(str(menu_name))
+        if fragment is None:
+            raise Http404("No MenuItem matches the given query.")
+        return fragment
+
+    def _find_active(self) -> Optional[Tuple[str, int]]:
+        if self.active_slug:
+            for name, fragment in self.fragments.items():
+                index = fragment.slugs.get(self.active_slug)
+                if index is not None:
+                    return name, index
+        return None
+
+    def _get_tree(self, menu_name: str) -> Optional[Tuple[TreeRow, ...]]:
+        if menu_name not in self.trees:
+            self.trees.update(MenuItem.objects.get_cached_trees([menu_name]))
+        return self.trees.get(menu_name)
+
+    async def _aget_tree(self, menu_name: str) -> Optional[Tuple[TreeRow, ...]]:
+        if menu_name not in self.trees:
+            self.trees.update(await MenuItem.objects.aget_cached_trees([menu_name]))
+        return self.trees.get(menu_name)
+
+    @property
+    def active_item(self) -> Optional[TreeRow]:
+        """row of active item in the first loaded menu holding it, or None"""
+        found = self._find_active()
+        rows = self._get_tree(found[0]) if found else None
+        return rows[found[1]] if rows else None
+
+    async def aget_active_item(self) -> Optional[TreeRow]:
+        """asynchronous active_item for async views"""
+        found = self._find_active()
+        rows = await self._aget_tree(found[0]) if found else None
+        return rows[found[1]] if rows else None
+
+    def get_breadcrumbs(self) -> List[TreeRow]:
+        """returns rows from menu root down to active item, or empty list"""
+        found = self._find_active()
+        rows = self._get_tree(found[0]) if found else None
+        if not rows:
+            return []
+        index, parents = found[1], self.fragments[found[0]].parents
+        breadcrumbs = []
+        while index != -1:
+            breadcrumbs.append(rows[index])
+            index = parents[index]
+        return breadcrumbs[::-1]
+
+
+def get_registry(request: HttpRequest) -> MenuRegistry:
+    """returns menu registry of request, set by menu_registry_middleware or
+    created on first use"""
+    registry = getattr(request, "menu_registry", None)
+    if registry is None:
+        registry = request.menu_registry = MenuRegistry.from_request(request)
+    return registry
+
+
+@register.simple_tag(takes_context=True)
+def load_menus(
+    context: Dict[str, Any], *menu_names: Union[SafeString, Iterable[str]]
+) -> str:
+    """prefetches menus drawn later in template, so that trees missing from cache
+    are loaded by a single query instead of one per draw_menu call. Takes menu
+    names, or lists of them, e.g. {% load_menus view.menus %}"""
+    names: List[str] = []
+    for name in menu_names:
+        names.extend([name] if isinstance(name, str) else name)
+    get_registry(context["request"]).load(names)
+    return ""
+
+
+@register.simple_tag(takes_context=True)
+def menu_breadcrumbs(context: Dict[str, Any]) -> List[TreeRow]:
+    """returns active item with its ancestors from menus loaded for the page,
+    starting from menu root, e.g. {% menu_breadcrumbs as breadcrumbs %}"""
+    return get_registry(context["request"]).get_breadcrumbs()
+
+
+@register.simple_tag(takes_context=True)
+def draw_menu(
+    context: Dict[str, Any], menu_name: SafeString, depth: Optional[int] = None
+):
+    """draws whole menu tree, or with depth only items up to depth levels below
+    root, plus active path with siblings and children of active item"""
+    registry = get_registry(context["request"])
+    active_menu = registry.active_slug
+
+    with instrumentation.measure(str(menu_name)) as timing:
+        if depth is not None:
+            fragment = get_expanded_fragment(str(menu_name), active_menu, int(depth))
+        else:
+            # preloaded by load_menus or view
+            fragment = registry.fragments.get(str(menu_name))
+            if fragment is None:
+                fragment = registry.get_fragment(menu_name)
+            else:
+                timing.cache_hit = True
+        timing.nodes = len(fragment.parents)
+        with instrumentation.timer("render_time"):
+            return fragment.render(active_menu)
@@ -29,3 +29,34 @@ class TestMenuAdminModelWithFixtures(TestCase):
         ]
 
         self.assertCountEqual(actual_values, expected_values)
+
+    def test_changelist_positions(self):
+        queryset = self.admin_model.get_queryset(request=None).order_by("id")
+
+        with self.assertNumQueries(1):
+            rows = [
+                (str(obj.parent), self.admin_model.child_position(obj))
+                for obj in queryset
+            ]
+
+        self.assertEqual(
+            rows,
+            [
+                ("None", None),
+                ("Clothing", "1/2"),
+                ("Clothing", "2/2"),
+                ("Men's", "1/1"),
+                ("Suits", "1/2"),
+                ("Suits", "2/2"),
+                ("Women's", "1/3"),
+                ("Women's", "2/3"),
+                ("Women's", "3/3"),
+                ("Dresses", "1/2"),
+                ("Dresses", "2/2"),
+            ],
+        )
+
+    def test_changelist_positions_filtered(self):
+        queryset = self.admin_model.get_queryset(request=None).filter(name="Blouses")
+
+        self.assertEqual(self.admin_model.child_position(queryset.get()), "3/3")
@@ -0,0 +1,219 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import resolve
+from menu_maker.models import MenuItem
+from menu_maker.templatetags.draw_menu import draw_menu
+
+
+class TestLoadTree(TestCase):
+    def _load(self, content: str, suffix: str) -> str:
+        with tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False) as file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+
+        out = StringIO()
+        call_command("load_tree", file.name, stdout=out)
+        return out.getvalue()
+
+    def _get_tree_values(self):
+        return list(MenuItem.objects.order_by("lft").values_list("name", "lft", "rgt"))
+
+    def test_load_json(self):
+        output = self._load(
+            '[{"name": "Clothing", "children": [{"name": "Men\'s"}, {"name": "Women\'s"}]}]',
+            ".json",
+        )
+
+        self.assertEqual(output, "Loaded 3 menu items\n")
+        self.assertEqual(
+            self._get_tree_values(),
+            [("Clothing", 1, 6), ("Men's", 2, 3), ("Women's", 4, 5)],
+        )
+
+    def test_load_csv(self):
+        output = self._load(
+            "id,parent,name,slug\n"
+            "3,1,Women's,ladies\n"
+            "1,,Clothing,\n"
+            "2,1,Men's,\n"
+            "4,3,Dresses,\n",
+            ".csv",
+        )
+
+        self.assertEqual(output, "Loaded 4 menu items\n")
+        self.assertEqual(
+            self._get_tree_values(),
+            [("Clothing", 1, 8), ("Women's", 2, 5), ("Dresses", 3, 4), ("Men's", 6, 7)],
+        )
+        self.assertEqual(MenuItem.objects.get(name="Women's").slug, "ladies")
+
+    def test_load_invalid(self):
+        self.assertRaises(
+            CommandError, self._load, '{"id": 1, "parent": 2, "name": "A"}\n', ".jsonl"
+        )
+        self.assertRaises(CommandError, self._load, "", ".txt")
+        # nested item without name
+        self.assertRaises(
+            CommandError, self._load, '[{"name": "A", "children": [{}]}]', ".json"
+        )
+        self.assertRaises(
+            CommandError, self._load, '[{"name": "A", "children": "B"}]', ".json"
+        )
+        # roots with the same slug
+        self.assertRaises(
+            CommandError, self._load, '[{"name": "A"}, {"name": "a"}]', ".json"
+        )
+        self.assertEqual(MenuItem.objects.count(), 0)
+
+
+class TestDumpTreeWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def _dump(self, *args: str) -> str:
+        out = StringIO()
+        call_command("dump_tree", *args, stdout=out)
+        return out.getvalue()
+
+    def test_dump_jsonl(self):
+        output = self._dump("Dresses")
+
+        self.assertEqual(
+            output,
+            '{"id": 7, "parent": null, "name": "Dresses", "slug": "dresses"}\n'
+            '{"id": 10, "parent": 7, "name": "Evening Gowns", "slug": "evening-gowns"}\n'
+            '{"id": 11, "parent": 7, "name": "Sun Dresses", "slug": "sun-dresses"}\n',
+        )
+
+    def test_dump_json(self):
+        output = self._dump("Men's", "--format", "json")
+
+        self.assertEqual(
+            json.loads(output),
+            [
+                {
+                    "name": "Men's",
+                    "slug": "mens",
+                    "children": [
+                        {
+                            "name": "Suits",
+                            "slug": "suits",
+                            "children": [
+                                {"name": "Slacks", "slug": "slacks", "children": []},
+                                {"name": "Jackets", "slug": "jackets", "children": []},
+                            ],
+                        }
+                    ],
+                }
+            ],
+        )
+
+    def test_dump_unknown_root(self):
+        self.assertRaises(CommandError, self._dump, "Unknown")
+
+        path = os.path.join(tempfile.mkdtemp(), "tree.json")
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        with self.assertRaises(CommandError):
+            call_command("dump_tree", "Unknown", "--format", "json", "--output", path)
+        # no truncated file is left behind
+        self.assertFalse(os.path.exists(path))
+
+    def test_round_trip(self):
+        expected = list(
+            MenuItem.objects.order_by("lft").values_list("name", "slug", "parent__name")
+        )
+        for format in ("json", "jsonl", "csv"):
+            with tempfile.NamedTemporaryFile(suffix=f".{format}") as file:
+                self._dump("--format", format, "--output", file.name)
+                MenuItem.objects.all().delete()
+                call_command("load_tree", file.name, stdout=StringIO())
+
+            actual = list(
+                MenuItem.objects.order_by("lft").values_list(
+                    "name", "slug", "parent__name"
+                )
+            )
+            self.assertEqual(actual, expected)
+
+
+class TestCheckTreeWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def test_valid(self):
+        out = StringIO()
+        call_command("check_tree", stdout=out)
+
+        self.assertEqual(out.getvalue(), "Menu trees are valid\n")
+
+    def test_rebuild(self):
+        expected = list(MenuItem.objects.order_by("id").values_list("lft", "rgt"))
+        MenuItem.objects.filter(name="Slacks").update(rgt=9)
+
+        with self.assertRaises(CommandError):
+            call_command("check_tree", stdout=StringIO(), stderr=StringIO())
+
+        out = StringIO()
+        err = StringIO()
+        call_command("check_tree", "--rebuild", stdout=out, stderr=err)
+
+        self.assertIn("Item 5: overlaps item 4", err.getvalue())
+        self.assertEqual(out.getvalue(), "Rebuilt menu trees, updated 1 menu items\n")
+        self.assertEqual(
+            list(MenuItem.objects.order_by("id").values_list("lft", "rgt")), expected
+        )
+
+
+class TestWarmMenusWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def setUp(self):
+        cache.clear()
+        # root without url, which can not be drawn
+        MenuItem(name="Shoes").save()
+        MenuItem(name="Electronics").save()
+
+    def _draw(self, menu_name: str) -> str:
+        request = RequestFactory().get("/")
+        request.resolver_match = resolve("/")
+        return draw_menu({"request": request}, menu_name)
+
+    def test_warm_menus(self):
+        out = StringIO()
+        err = StringIO()
+        # roots, tree version, then top nodes and rows of both trees
+        with self.assertNumQueries(4):
+            call_command("warm_menus", stdout=out, stderr=err)
+
+        self.assertEqual(
+            out.getvalue(), "Warmed up 2 menus\n  Clothing\n  Electronics\n"
+        )
+        # tests use local memory cache
+        self.assertIn("local to this process", err.getvalue())
+        # only tree version is read
+        with self.assertNumQueries(1):
+            self._draw("Clothing")
+        with self.assertNumQueries(1):
+            self._draw("Electronics")
+
+        cache.clear()
+        with self.assertNumQueries(6):
+            call_command(
+                "warm_menus",
+                "--batch-size",
+                "1",
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+
+    @override_settings(MENU_MAKER_WARM_ON_STARTUP=True)
+    def test_warm_on_startup(self):
+        with self.assertLogs("menu_maker.apps", "INFO"):
+            apps.get_app_config("menu_maker").ready()
+
+        with self.assertNumQueries(1):
+            self._draw("Clothing")
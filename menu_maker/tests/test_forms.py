@@ -41,7 +41,7 @@ class TestMenuItemFormWithFixtures(TestCase):
             ("Blouses", 19, 20),
             ("Evening Gowns", 12, 13),
             ("Sun Dresses", 14, 15),
-            ("new root", 23, 24),
+            ("new root", 1, 2),
         ]
 
         self.assertCountEqual(actual_values, expected_values)
@@ -0,0 +1,144 @@
+from io import StringIO
+from typing import List
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import resolve, reverse
+from menu_maker import instrumentation
+from menu_maker.instrumentation import MenuTiming
+
+collected: List[MenuTiming] = []
+
+
+def collect(timing: MenuTiming):
+    collected.append(timing)
+
+
+def fail(timing: MenuTiming):
+    raise ValueError("metrics are down")
+
+
+class TestInstrumentationWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def setUp(self):
+        cache.clear()
+        collected.clear()
+        self.factory = RequestFactory()
+
+    def _render(self, template: str, path: str = "/clothing/dresses/") -> str:
+        request = self.factory.get(path)
+        request.resolver_match = resolve(path)
+        return Template("{% load draw_menu %}" + template).render(
+            Context({"request": request})
+        )
+
+    def _draw(self, template: str = "{% draw_menu 'Clothing' %}"):
+        token = instrumentation.start_request()
+        self._render(template)
+        return instrumentation.end_request(token)
+
+    def test_draw_menu(self):
+        (timing,) = self._draw()
+
+        self.assertEqual(timing.name, "Clothing")
+        self.assertIs(timing.cache_hit, False)
+        # tree version, top node and rows
+        self.assertEqual(timing.queries, 3)
+        self.assertEqual(timing.nodes, 11)
+        self.assertGreater(timing.db_time, 0)
+        self.assertGreater(timing.annotate_time, 0)
+        self.assertGreater(timing.render_time, 0)
+        self.assertGreaterEqual(
+            timing.duration, timing.db_time + timing.annotate_time + timing.render_time
+        )
+
+        (timing,) = self._draw()
+        self.assertIs(timing.cache_hit, True)
+        self.assertEqual(timing.queries, 1)
+        self.assertEqual(timing.nodes, 11)
+
+    def test_load_menus(self):
+        timings = self._draw("{% load_menus 'Clothing' %}{% draw_menu 'Clothing' %}")
+
+        self.assertEqual([timing.name for timing in timings], ["Clothing", "Clothing"])
+        self.assertEqual([timing.queries for timing in timings], [3, 0])
+        self.assertEqual([timing.nodes for timing in timings], [11, 11])
+        self.assertEqual([timing.cache_hit for timing in timings], [False, True])
+
+    def test_draw_menu_depth(self):
+        (timing,) = self._draw("{% draw_menu 'Clothing' depth=1 %}")
+
+        self.assertIs(timing.cache_hit, False)
+        self.assertEqual(timing.nodes, 8)
+
+    def test_log_record(self):
+        with self.assertLogs("menu_maker.instrumentation", "INFO") as logs:
+            self._draw()
+
+        (record,) = logs.records
+        self.assertTrue(record.getMessage().startswith("Menu Clothing drawn in "))
+        self.assertEqual(record.menu_timing["queries"], 3)
+        self.assertEqual(record.menu_timing["cache_hit"], False)
+
+    @override_settings(
+        MENU_MAKER_METRICS_HOOK="menu_maker.tests.test_instrumentation.collect"
+    )
+    def test_metrics_hook(self):
+        (timing,) = self._draw()
+
+        self.assertEqual(collected, [timing])
+
+    @override_settings(MENU_MAKER_METRICS_HOOK=fail)
+    def test_metrics_hook_error(self):
+        with self.assertLogs("menu_maker.instrumentation", "ERROR"):
+            html = self._render("{% draw_menu 'Clothing' %}")
+
+        self.assertIn("Clothing", html)
+
+    def test_server_timing(self):
+        timing = MenuTiming('Shoes "A"')
+        timing.duration = 0.00125
+        timing.queries = 2
+        timing.cache_hit = False
+
+        self.assertEqual(
+            timing.server_timing(),
+            'menu;dur=1.25;desc="Shoes \\"A\\" miss nodes=0 queries=2 db=0.00'
+            ' annotate=0.00 render=0.00"',
+        )
+
+        # non-ASCII names are percent-encoded, so that header is not MIME-encoded
+        timing = MenuTiming("Одежда 100%")
+        self.assertTrue(
+            timing.server_timing().startswith(
+                'menu;dur=0.00;desc="%D0%9E%D0%B4%D0%B5%D0%B6%D0%B4%D0%B0 100%25 -'
+            )
+        )
+        response = HttpResponse()
+        response["Server-Timing"] = timing.server_timing()
+        self.assertEqual(response["Server-Timing"], timing.server_timing())
+
+
+class TestServerTimingMiddleware(TestCase):
+    def setUp(self):
+        cache.clear()
+        call_command("load_sample", stdout=StringIO())
+
+    def test_home_view(self):
+        response = self.client.get(reverse("clothing", args=["dresses"]))
+
+        metrics = response["Server-Timing"].split(", ")
+        # menus loaded by async view, then drawn by template
+        self.assertEqual(len(metrics), 3)
+        self.assertIn('desc="Clothing,Electronics miss', metrics[0])
+        self.assertIn("queries=3", metrics[0])
+        self.assertIn('desc="Clothing hit', metrics[1])
+        self.assertIn('desc="Electronics hit', metrics[2])
+
+    def test_no_menus(self):
+        response = self.client.get(reverse("menu_maker:children", args=[1]))
+
+        self.assertFalse(response.has_header("Server-Timing"))
@@ -1,4 +1,13 @@
-from django.test import TestCase
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models.signals import post_delete
+from django.http import Http404
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from menu_maker import cache as menu_cache
 from menu_maker.models import MenuItem
 
 
@@ -29,6 +38,199 @@ class TestMenuItemModelWithFixtures(TestCase):
         self.assertEqual(len(items_by_name), 3)
         self.assertRaises(TypeError, MenuItem.objects.get_tree, [])
 
+    def test_get_cached_tree(self):
+        cache.clear()
+        # tree version, top node and rows
+        with self.assertNumQueries(3):
+            rows = MenuItem.objects.get_cached_tree("Dresses")
+        with self.assertNumQueries(1):
+            cached_rows = MenuItem.objects.get_cached_tree("Dresses")
+        # version is read once per request
+        with self.assertNumQueries(1), menu_cache.version_scope():
+            MenuItem.objects.get_cached_tree("Dresses")
+            MenuItem.objects.get_cached_tree("Dresses")
+
+        self.assertEqual(rows, cached_rows)
+        self.assertEqual(
+            [row.name for row in rows], ["Dresses", "Evening Gowns", "Sun Dresses"]
+        )
+        self.assertRaises(Http404, MenuItem.objects.get_cached_tree, "Unknown")
+
+    def test_get_cached_tree_after_change(self):
+        cache.clear()
+        MenuItem.objects.get_cached_tree("dresses")
+        node = MenuItem.objects.get(name="Sun Dresses")
+        node.name = "Summer Dresses"
+        node.save()
+
+        rows = MenuItem.objects.get_cached_tree("dresses")
+        self.assertEqual(rows[2].name, "Summer Dresses")
+
+        node.delete()
+
+        rows = MenuItem.objects.get_cached_tree("dresses")
+        self.assertEqual(len(rows), 2)
+
+    def test_tree_version(self):
+        version = menu_cache.get_tree_version()
+        # version is kept in database, not in cache of one process
+        cache.clear()
+        self.assertEqual(menu_cache.get_tree_version(), version)
+
+        with transaction.atomic():
+            node = MenuItem.objects.get(name="Skirts")
+            node.name = "Pants"
+            node.save()
+            self.assertGreater(menu_cache.get_tree_version(), version)
+            transaction.set_rollback(True)
+        self.assertEqual(menu_cache.get_tree_version(), version)
+
+    async def test_aget_tree(self):
+        items = await MenuItem.objects.aget_tree("Dresses")
+        self.assertEqual(
+            [item.name for item in items], ["Dresses", "Evening Gowns", "Sun Dresses"]
+        )
+        items = await MenuItem.objects.aget_tree(3, max_depth=1)
+        self.assertEqual(len(items), 4)
+        with self.assertRaises(Http404):
+            await MenuItem.objects.aget_tree("Unknown")
+
+    async def test_aget_descendants(self):
+        items = await MenuItem.objects.aget_descendants(3)
+        self.assertEqual(len(items), 5)
+        items = await MenuItem.objects.aget_descendants(3, direct_only=True)
+        self.assertEqual(len(items), 3)
+        with self.assertRaises(Http404):
+            await MenuItem.objects.aget_descendants(1000)
+
+    async def test_aget_cached_trees(self):
+        await cache.aclear()
+        trees = await MenuItem.objects.aget_cached_trees(["Dresses", "Unknown"])
+        self.assertEqual(list(trees), ["Dresses"])
+        self.assertEqual(len(trees["Dresses"]), 3)
+        self.assertEqual(
+            trees["Dresses"],
+            await sync_to_async(MenuItem.objects.get_cached_tree)("Dresses"),
+        )
+
+    def test_get_tree_max_depth(self):
+        items = MenuItem.objects.get_tree("Clothing", max_depth=1)
+        self.assertEqual(
+            [item.name for item in items], ["Clothing", "Men's", "Women's"]
+        )
+        items = MenuItem.objects.get_tree("Women's", max_depth=1)
+        self.assertEqual(len(items), 4)
+
+    def test_get_ancestors(self):
+        node = MenuItem.objects.get(name="Sun Dresses")
+        with self.assertNumQueries(1):
+            ancestors = [item.name for item in MenuItem.objects.get_ancestors(node.id)]
+        self.assertEqual(ancestors, ["Clothing", "Women's", "Dresses"])
+
+        ancestors = MenuItem.objects.get_ancestors(node.id, include_self=True)
+        self.assertEqual(len(ancestors), 4)
+
+    def test_get_by_path(self):
+        node = MenuItem.objects.get_by_path("clothing/womens/dresses/")
+        self.assertEqual(node.name, "Dresses")
+        self.assertRaises(Http404, MenuItem.objects.get_by_path, "womens/dresses")
+
+    def test_depth_and_path(self):
+        parent_node = MenuItem.objects.get(name="Dresses")
+        new_node = MenuItem(name="New Item", lft=0, rgt=0, parent=parent_node)
+        new_node.save()
+        self.assertEqual(new_node.depth, 3)
+        self.assertEqual(new_node.path, "clothing/womens/dresses/new-item")
+
+        node = MenuItem.objects.get(name="Women's")
+        node.parent = MenuItem.objects.get(name="Suits")
+        node.slug = "ladies"
+        node.save()
+        node = MenuItem.objects.get(name="Dresses")
+        node.slug = "gowns"
+        node.save()
+
+        self.assertEqual(
+            list(
+                MenuItem.objects.get_tree("Suits").values_list("name", "depth", "path")
+            ),
+            [
+                ("Suits", 2, "clothing/mens/suits"),
+                ("Slacks", 3, "clothing/mens/suits/slacks"),
+                ("Jackets", 3, "clothing/mens/suits/jackets"),
+                ("Women's", 3, "clothing/mens/suits/ladies"),
+                ("Dresses", 4, "clothing/mens/suits/ladies/gowns"),
+                ("Evening Gowns", 5, "clothing/mens/suits/ladies/gowns/evening-gowns"),
+                ("Sun Dresses", 5, "clothing/mens/suits/ladies/gowns/sun-dresses"),
+                ("New Item", 5, "clothing/mens/suits/ladies/gowns/new-item"),
+                ("Skirts", 4, "clothing/mens/suits/ladies/skirts"),
+                ("Blouses", 4, "clothing/mens/suits/ladies/blouses"),
+            ],
+        )
+
+        node = MenuItem.objects.get(name="Women's")
+        node.parent = None
+        node.save()
+        self.assertEqual(MenuItem.objects.get(name="Skirts").path, "ladies/skirts")
+        self.assertEqual(MenuItem.objects.get(name="Skirts").depth, 1)
+
+    def test_depth_and_path_stale_item(self):
+        dresses = MenuItem.objects.get(name="Dresses")
+        slacks = MenuItem.objects.get(name="Slacks")
+        # ancestors are changed after items were loaded
+        node = MenuItem.objects.get(name="Women's")
+        node.slug = "w"
+        node.save()
+        node = MenuItem.objects.get(name="Suits")
+        node.parent = MenuItem.objects.get(name="Clothing")
+        node.save()
+
+        dresses.name = "Gowns"
+        dresses.save()
+        slacks.name = "Trousers"
+        slacks.save()
+
+        node = MenuItem.objects.get_by_path("clothing/w/dresses")
+        self.assertEqual((node.name, node.depth), ("Gowns", 2))
+        node = MenuItem.objects.get_by_path("clothing/suits/slacks")
+        self.assertEqual((node.name, node.depth), ("Trousers", 2))
+
+    def test_rename_stale_item(self):
+        skirts = MenuItem.objects.get(name="Skirts")
+        # item is moved by another writer after it was loaded
+        node = MenuItem.objects.get(name="Skirts")
+        node.parent = MenuItem.objects.get(name="Men's")
+        node.save()
+
+        skirts.name = "Pants"
+        skirts.save()
+
+        node = MenuItem.objects.get(name="Pants")
+        self.assertEqual(node.parent.name, "Men's")
+        self.assertEqual(MenuItem.objects.check_tree(), [])
+
+    def test_rename_refreshed_item(self):
+        node = MenuItem.objects.get(name="Dresses")
+        # item is moved by another writer, then reloaded
+        moved = MenuItem.objects.get(name="Dresses")
+        moved.parent = MenuItem.objects.get(name="Men's")
+        moved.set_new_position(0)
+        moved.save()
+        node.refresh_from_db()
+        men = MenuItem.objects.get(name="Men's")
+        children = MenuItem.objects.get_descendants(men.id, True)
+        names = [child.name for child in children]
+
+        node.name = "Gowns"
+        node.save()
+
+        children = MenuItem.objects.get_descendants(men.id, True)
+        self.assertEqual(
+            [child.name for child in children],
+            [name.replace("Dresses", "Gowns") for name in names],
+        )
+        self.assertEqual(MenuItem.objects.check_tree(), [])
+
     def test_get_position(self):
         root = MenuItem.objects.get(name="Clothing")
         node1 = MenuItem.objects.get(name="Dresses")
@@ -54,10 +256,13 @@ class TestMenuItemModelWithFixtures(TestCase):
             ("Blouses", 19, 20),
             ("Evening Gowns", 12, 13),
             ("Sun Dresses", 14, 15),
-            ("new root", 23, 24),
+            ("new root", 1, 2),
         ]
 
         self.assertCountEqual(actual_values, expected_values)
+        # new root starts a separate tree
+        self.assertEqual(new_root.tree_id, 2)
+        self.assertEqual(MenuItem.objects.filter(tree_id=1).count(), 11)
 
     def test_add_child_item_default(self):
         parent_node = MenuItem.objects.get(name="Women's")
@@ -161,6 +366,140 @@ class TestMenuItemModelWithFixtures(TestCase):
         self.assertCountEqual(actual_values, expected_values)
         self.assertEqual(node.get_position(), (1, 2))
 
+    def test_move_item_query_count(self):
+        new_parent = MenuItem.objects.get(name="Men's")
+        node = MenuItem.objects.get(name="Women's")
+        node.parent = new_parent
+
+        with CaptureQueriesContext(connection) as context:
+            node.save()
+
+        updates = [q["sql"] for q in context if q["sql"].startswith("UPDATE")]
+        # tree lock, subtree move, node save and version
+        self.assertEqual(len(updates), 4)
+
+        self.assertEqual((node.lft, node.rgt), (9, 20))
+        self.assertEqual(MenuItem.objects.get(name="Men's").rgt, 21)
+        self.assertEqual(MenuItem.objects.get(name="Sun Dresses").lft, 13)
+
+    def test_add_child_item_stale_parent(self):
+        parent_node = MenuItem.objects.get(name="Dresses")
+        # another writer shifts numbering after parent was loaded
+        MenuItem(
+            name="Ties", lft=0, rgt=0, parent=MenuItem.objects.get(name="Men's")
+        ).save()
+
+        new_node = MenuItem(name="New Item", lft=0, rgt=0, parent=parent_node)
+        new_node.set_new_position(0)
+        new_node.save()
+
+        self.assertEqual((new_node.lft, new_node.rgt), (14, 15))
+        self.assertEqual(MenuItem.objects.get(name="Dresses").rgt, 20)
+
+    def test_delete_stale_item(self):
+        node = MenuItem.objects.get(name="Dresses")
+        MenuItem(
+            name="Ties", lft=0, rgt=0, parent=MenuItem.objects.get(name="Men's")
+        ).save()
+
+        node.delete()
+
+        self.assertEqual(
+            list(
+                MenuItem.objects.get_tree("Women's").values_list("name", "lft", "rgt")
+            ),
+            [("Women's", 12, 17), ("Skirts", 13, 14), ("Blouses", 15, 16)],
+        )
+        self.assertEqual(MenuItem.objects.get(name="Clothing").rgt, 18)
+
+    def test_add_child_item_other_tree(self):
+        electronics = MenuItem(name="Electronics", lft=0, rgt=0)
+        electronics.save()
+        MenuItem(name="Laptops", lft=0, rgt=0, parent=electronics).save()
+        parent_node = MenuItem.objects.get(name="Women's")
+
+        with CaptureQueriesContext(connection) as context:
+            MenuItem(name="New Item", lft=0, rgt=0, parent=parent_node).save()
+
+        shifts = [q["sql"] for q in context if 'menu_maker_menuitem" SET' in q["sql"]]
+        self.assertEqual(len(shifts), 2)
+        for sql in shifts:
+            self.assertIn('"menu_maker_menuitem"."tree_id" = 1', sql)
+        self.assertEqual(
+            list(MenuItem.objects.get_tree("Electronics").values_list("lft", "rgt")),
+            [(1, 4), (2, 3)],
+        )
+
+    def test_move_item_to_other_tree(self):
+        electronics = MenuItem(name="Electronics", lft=0, rgt=0)
+        electronics.save()
+        MenuItem(name="Laptops", lft=0, rgt=0, parent=electronics).save()
+
+        node = MenuItem.objects.get(name="Dresses")
+        node.parent = electronics
+        node.set_new_position(0)
+        node.save()
+
+        self.assertEqual(
+            list(
+                MenuItem.objects.get_tree("Electronics").values_list(
+                    "name", "tree_id", "lft", "rgt", "path"
+                )
+            ),
+            [
+                ("Electronics", 2, 1, 10, "electronics"),
+                ("Dresses", 2, 2, 7, "electronics/dresses"),
+                ("Evening Gowns", 2, 3, 4, "electronics/dresses/evening-gowns"),
+                ("Sun Dresses", 2, 5, 6, "electronics/dresses/sun-dresses"),
+                ("Laptops", 2, 8, 9, "electronics/laptops"),
+            ],
+        )
+        self.assertEqual(
+            list(MenuItem.objects.get_tree("Women's").values_list("lft", "rgt")),
+            [(10, 15), (11, 12), (13, 14)],
+        )
+        self.assertEqual(MenuItem.objects.get(name="Clothing").rgt, 16)
+
+    def test_move_item_under_descendant(self):
+        node = MenuItem.objects.get(name="Women's")
+        node.parent = MenuItem.objects.get(name="Dresses")
+
+        with self.assertLogs("menu_maker.models", "ERROR") as logs:
+            self.assertRaises(ValueError, node.save)
+        self.assertEqual(
+            logs.records[0].getMessage(), "Error when moving under new parent"
+        )
+
+    def test_move_item_to_root(self):
+        node = MenuItem.objects.get(name="Dresses")
+        node.parent = None
+
+        node.save()
+
+        actual_values = self._get_tree_values()
+        expected_values = [
+            ("Clothing", 1, 16),
+            ("Men's", 2, 9),
+            ("Women's", 10, 15),
+            ("Suits", 3, 8),
+            ("Slacks", 4, 5),
+            ("Jackets", 6, 7),
+            ("Dresses", 1, 6),
+            ("Skirts", 11, 12),
+            ("Blouses", 13, 14),
+            ("Evening Gowns", 2, 3),
+            ("Sun Dresses", 4, 5),
+        ]
+
+        self.assertCountEqual(actual_values, expected_values)
+        self.assertEqual(node.tree_id, 2)
+        self.assertEqual(
+            list(
+                MenuItem.objects.get_tree("Dresses").values_list("tree_id", flat=True)
+            ),
+            [2, 2, 2],
+        )
+
     def test_change_siblings_order(self):
         node = MenuItem.objects.get(name="Dresses")
         node.set_new_position(-1)
@@ -207,6 +546,33 @@ class TestMenuItemModelWithFixtures(TestCase):
 
         self.assertCountEqual(actual_values, expected_values)
 
+    def test_change_name_query_count(self):
+        node = MenuItem.objects.get(name="Skirts")
+        node.name = "Pants"
+
+        # savepoint, update, version, release
+        with self.assertNumQueries(4):
+            node.save()
+
+        # tree lock is taken and paths of descendants are updated as well
+        node.slug = "pants"
+        with self.assertNumQueries(7):
+            node.save()
+
+        node.set_new_position(1)
+        with self.assertNumQueries(6):
+            node.save()
+
+    def test_change_siblings_order_first(self):
+        node = MenuItem.objects.get(name="Blouses")
+        node.set_new_position(0)
+
+        node.save()
+
+        self.assertEqual(node.get_position(), (1, 3))
+        self.assertEqual((node.lft, node.rgt), (11, 12))
+        self.assertEqual(MenuItem.objects.get(name="Dresses").lft, 13)
+
     def test_delete_model(self):
         node = MenuItem.objects.get(name="Dresses")
         node.delete()
@@ -241,11 +607,404 @@ class TestMenuItemModelWithFixtures(TestCase):
 
         self.assertCountEqual(actual_values, expected_values)
 
+    def test_delete_nodes(self):
+        ids = MenuItem.objects.filter(
+            name__in=["Suits", "Jackets", "Dresses", "Skirts"]
+        ).values_list("id", flat=True)
+
+        signalled = []
+
+        def receiver(instance, **kwargs):
+            signalled.append(instance.name)
+
+        post_delete.connect(receiver, sender=MenuItem)
+        self.addCleanup(post_delete.disconnect, receiver, sender=MenuItem)
+
+        deleted = MenuItem.objects.delete_nodes(list(ids))
+
+        # descendants are deleted through collector, which sends signals
+        self.assertEqual(len(signalled), 7)
+        actual_values = MenuItem.objects.order_by("id").values_list(
+            "name", "lft", "rgt"
+        )
+        expected_values = [
+            ("Clothing", 1, 8),
+            ("Men's", 2, 3),
+            ("Women's", 4, 7),
+            ("Blouses", 5, 6),
+        ]
+        self.assertEqual(deleted, 7)
+        self.assertCountEqual(actual_values, expected_values)
+        self.assertEqual(MenuItem.objects.delete_nodes([]), 0)
+
+    def test_delete_nodes_several_trees(self):
+        MenuItem.objects.bulk_load_tree(
+            [{"name": "Electronics", "children": [{"name": "Laptops"}, {"name": "TV"}]}]
+        )
+        ids = MenuItem.objects.filter(name__in=["Men's", "Laptops"]).values("id")
+
+        self.assertEqual(MenuItem.objects.delete_nodes(ids), 5)
+
+        self.assertEqual(
+            list(MenuItem.objects.get_tree("Electronics").values_list("lft", "rgt")),
+            [(1, 4), (2, 3)],
+        )
+        self.assertEqual(MenuItem.objects.get(name="Clothing").rgt, 14)
+
+    def test_reorder_children(self):
+        womens = MenuItem.objects.get(name="Women's")
+        # savepoint, parent tree, lock, children, update and version
+        with self.assertNumQueries(7):
+            MenuItem.objects.reorder_children(womens, [9, 7, 8])
+
+        actual_values = MenuItem.objects.get_tree(womens.id).values_list(
+            "name", "lft", "rgt"
+        )
+        expected_values = [
+            ("Women's", 10, 21),
+            ("Blouses", 11, 12),
+            ("Dresses", 13, 18),
+            ("Evening Gowns", 14, 15),
+            ("Sun Dresses", 16, 17),
+            ("Skirts", 19, 20),
+        ]
+        self.assertEqual(list(actual_values), expected_values)
+        self.assertEqual(MenuItem.objects.get(name="Clothing").rgt, 22)
+
+        # same order, nothing to update
+        with self.assertNumQueries(5):
+            MenuItem.objects.reorder_children(womens.id, [9, 7, 8])
+
+    def test_reorder_children_invalid(self):
+        for ordered_ids in ([7, 8], [7, 8, 9, 9], [7, 8, 2]):
+            with self.assertRaises(ValueError):
+                MenuItem.objects.reorder_children(3, ordered_ids)
+        self.assertEqual(MenuItem.objects.get(name="Dresses").lft, 11)
+
+    def test_check_tree(self):
+        self.assertEqual(MenuItem.objects.check_tree(), [])
+
+        MenuItem.objects.filter(name="Blouses").update(lft=18)
+        MenuItem.objects.filter(name="Women's").update(rgt=23)
+
+        self.assertEqual(
+            MenuItem.objects.check_tree(1),
+            [
+                "Item 3: overlaps item 1",
+                "Item 9: overlaps item 8",
+                "Item 9: not contained in its parent 3",
+                "Item 9: gap between 18 and 20",
+                "Item 8: 18 overlaps previous value 20",
+                "Item 3: gap between 18 and 23",
+                "Item 1: 22 overlaps previous value 23",
+            ],
+        )
+        self.assertEqual(MenuItem.objects.check_tree(2), [])
+
+    def test_check_tree_parents(self):
+        MenuItem.objects.filter(name="Dresses").update(parent_id=2)
+        MenuItem.objects.create(name="Electronics")
+        MenuItem.objects.filter(name="Electronics").update(tree_id=1, lft=23, rgt=24)
+
+        self.assertEqual(
+            MenuItem.objects.check_tree(),
+            [
+                "Item 7: not contained in its parent 2",
+                "Item 12: second root of tree 1",
+            ],
+        )
+
+    def test_rebuild(self):
+        # parent changed without moving nested set
+        MenuItem.objects.filter(name="Dresses").update(parent_id=2)
+
+        # savepoint, tree ids, two locks, select, update and version
+        with self.assertNumQueries(8):
+            updated = MenuItem.objects.rebuild()
+
+        actual_values = MenuItem.objects.order_by("lft").values_list(
+            "name", "lft", "rgt", "depth", "path"
+        )
+        expected_values = [
+            ("Clothing", 1, 22, 0, "clothing"),
+            ("Men's", 2, 15, 1, "clothing/mens"),
+            ("Suits", 3, 8, 2, "clothing/mens/suits"),
+            ("Slacks", 4, 5, 3, "clothing/mens/suits/slacks"),
+            ("Jackets", 6, 7, 3, "clothing/mens/suits/jackets"),
+            ("Dresses", 9, 14, 2, "clothing/mens/dresses"),
+            ("Evening Gowns", 10, 11, 3, "clothing/mens/dresses/evening-gowns"),
+            ("Sun Dresses", 12, 13, 3, "clothing/mens/dresses/sun-dresses"),
+            ("Women's", 16, 21, 1, "clothing/womens"),
+            ("Skirts", 17, 18, 2, "clothing/womens/skirts"),
+            ("Blouses", 19, 20, 2, "clothing/womens/blouses"),
+        ]
+        self.assertEqual(updated, 5)
+        self.assertEqual(list(actual_values), expected_values)
+        self.assertEqual(MenuItem.objects.check_tree(), [])
+        self.assertEqual(MenuItem.objects.rebuild(), 0)
+
+    def test_rebuild_cycle(self):
+        MenuItem.objects.filter(name="Men's").update(parent_id=4)
+
+        with self.assertRaises(ValueError):
+            MenuItem.objects.rebuild()
+        self.assertEqual(MenuItem.objects.get(name="Women's").lft, 10)
+
 
 class TestMenuItemModelWithBlankDb(TestCase):
+    def test_bulk_load_tree(self):
+        tree = [
+            {
+                "name": "Clothing",
+                "children": [
+                    {"name": "Men's", "children": [{"name": "Suits"}]},
+                    {"name": "Women's", "slug": "ladies"},
+                ],
+            },
+            {"name": "Electronics"},
+        ]
+        # savepoint, tree lock, max tree_id, one insert per level, version, release
+        with self.assertNumQueries(8):
+            items = MenuItem.objects.bulk_load_tree(tree, batch_size=2)
+
+        self.assertEqual(
+            [(item.name, item.tree_id, item.lft, item.rgt) for item in items],
+            [
+                ("Clothing", 1, 1, 8),
+                ("Men's", 1, 2, 5),
+                ("Suits", 1, 3, 4),
+                ("Women's", 1, 6, 7),
+                ("Electronics", 2, 1, 2),
+            ],
+        )
+        self.assertEqual(
+            list(
+                MenuItem.objects.order_by("tree_id", "lft").values_list(
+                    "slug", "parent__name", "depth", "path"
+                )
+            ),
+            [
+                ("clothing", None, 0, "clothing"),
+                ("mens", "Clothing", 1, "clothing/mens"),
+                ("suits", "Men's", 2, "clothing/mens/suits"),
+                ("ladies", "Clothing", 1, "clothing/ladies"),
+                ("electronics", None, 0, "electronics"),
+            ],
+        )
+
     def test_create_new_root(self):
         new_root = MenuItem(name="new root", lft=0, rgt=0)
         new_root.save()
 
         self.assertEqual(new_root.lft, 1)
         self.assertEqual(new_root.rgt, 2)
+
+    def test_unique_root_slug(self):
+        root = MenuItem(name="Clothing", lft=0, rgt=0)
+        root.save()
+        # only roots are unique, nested items may repeat slugs
+        MenuItem(name="Clothing", lft=0, rgt=0, parent=root).save()
+        with self.assertRaises(IntegrityError):
+            MenuItem(name="Clothing", lft=0, rgt=0).save()
+
+    @override_settings(MENU_MAKER_SPACING=2)
+    def test_invalid_spacing(self):
+        # with spacing 2 there is no free number between neighbouring values
+        with self.assertRaises(ImproperlyConfigured), self.assertLogs(
+            "menu_maker.models", "ERROR"
+        ):
+            MenuItem(name="Clothing", lft=0, rgt=0).save()
+        self.assertFalse(MenuItem.objects.exists())
+
+
+@override_settings(MENU_MAKER_SPACING=10)
+class TestMenuItemModelGappedWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def _get_tree_names(self):
+        return list(
+            MenuItem.objects.get_tree("Clothing").values_list("name", flat=True)
+        )
+
+    def test_rebalance(self):
+        MenuItem.objects.rebalance()
+
+        self.assertEqual(
+            list(MenuItem.objects.order_by("id").values_list("lft", "rgt"))[:4],
+            [(10, 220), (20, 90), (100, 210), (30, 80)],
+        )
+
+    def test_reorder_children(self):
+        MenuItem.objects.rebalance()
+        MenuItem.objects.filter(name="Skirts").delete()
+
+        MenuItem.objects.reorder_children(3, [9, 7])
+
+        self.assertEqual(
+            list(
+                MenuItem.objects.get_tree("Women's").values_list("name", "lft", "rgt")
+            ),
+            [
+                ("Women's", 100, 210),
+                ("Blouses", 110, 120),
+                # gap of deleted item stays after the first child
+                ("Dresses", 150, 200),
+                ("Evening Gowns", 160, 170),
+                ("Sun Dresses", 180, 190),
+            ],
+        )
+
+    def test_rebuild(self):
+        self.assertEqual(MenuItem.objects.rebuild(), 11)
+
+        self.assertEqual(
+            list(MenuItem.objects.order_by("id").values_list("lft", "rgt"))[:4],
+            [(10, 220), (20, 90), (100, 210), (30, 80)],
+        )
+        # gaps between values are allowed
+        self.assertEqual(MenuItem.objects.check_tree(), [])
+
+    def test_add_child_item(self):
+        parent_node = MenuItem.objects.get(name="Women's")
+        first_node = MenuItem(name="first item", lft=0, rgt=0, parent=parent_node)
+        first_node.save()  # renumbers dense fixture
+
+        numbering = list(
+            MenuItem.objects.order_by("id").values_list("id", "lft", "rgt")
+        )
+        second_node = MenuItem(name="second item", lft=0, rgt=0, parent=parent_node)
+        second_node.set_new_position(0)
+        with CaptureQueriesContext(connection) as context:
+            second_node.save()
+
+        updates = [q["sql"] for q in context if q["sql"].startswith("UPDATE")]
+        # only tree lock is taken and tree version bumped
+        self.assertEqual(len(updates), 2)
+        self.assertIn("menu_maker_treelock", updates[0])
+        self.assertIn("menu_maker_treeversion", updates[1])
+        self.assertEqual(
+            numbering,
+            list(MenuItem.objects.order_by("id").values_list("id", "lft", "rgt"))[:-1],
+        )
+        self.assertEqual(
+            self._get_tree_names(),
+            [
+                "Clothing",
+                "Men's",
+                "Suits",
+                "Slacks",
+                "Jackets",
+                "Women's",
+                "second item",
+                "Dresses",
+                "Evening Gowns",
+                "Sun Dresses",
+                "Skirts",
+                "Blouses",
+                "first item",
+            ],
+        )
+        self.assertEqual(second_node.get_position(), (1, 5))
+
+    def test_move_item(self):
+        MenuItem.objects.rebalance()
+        node = MenuItem.objects.get(name="Dresses")
+        node.parent = MenuItem.objects.get(name="Men's")
+
+        node.save()
+
+        self.assertEqual(
+            self._get_tree_names(),
+            [
+                "Clothing",
+                "Men's",
+                "Suits",
+                "Slacks",
+                "Jackets",
+                "Dresses",
+                "Evening Gowns",
+                "Sun Dresses",
+                "Women's",
+                "Skirts",
+                "Blouses",
+            ],
+        )
+        self.assertEqual(MenuItem.objects.get_descendants(node.id).count(), 2)
+
+    def test_delete_model(self):
+        MenuItem.objects.rebalance()
+        node = MenuItem.objects.get(name="Dresses")
+        node.delete()
+
+        self.assertEqual(MenuItem.objects.get(name="Clothing").rgt, 220)
+        self.assertEqual(
+            self._get_tree_names(),
+            [
+                "Clothing",
+                "Men's",
+                "Suits",
+                "Slacks",
+                "Jackets",
+                "Women's",
+                "Skirts",
+                "Blouses",
+            ],
+        )
+
+
+@override_settings(MENU_MAKER_LOCK_RETRY_DELAY=0)
+class TestMenuItemTreeLock(TransactionTestCase):
+    fixtures = ["menu_maker.json"]
+
+    def test_retry_when_database_locked(self):
+        locked = OperationalError("database is locked")
+        with mock.patch("menu_maker.models._lock_trees", side_effect=[locked, None]):
+            node = MenuItem(name="New Item", lft=0, rgt=0)
+            with self.assertLogs("menu_maker.models", "WARNING") as logs:
+                node.save()
+
+        # repeated attempt is logged as warning, without error
+        (record,) = logs.records
+        self.assertEqual(record.levelname, "WARNING")
+        self.assertTrue(
+            record.getMessage().startswith(
+                "Database is locked, retrying MenuItem.save in"
+            )
+        )
+
+        self.assertEqual((node.lft, node.rgt), (1, 2))
+        self.assertEqual(MenuItem.objects.filter(name="New Item").count(), 1)
+
+    def test_no_retry(self):
+        errors = [OperationalError("database is locked")] * 5
+        with mock.patch("menu_maker.models._lock_trees", side_effect=errors) as lock:
+            with self.assertLogs("menu_maker.models", "WARNING") as logs:
+                self.assertRaises(OperationalError, MenuItem.objects.rebalance)
+        # first attempt and LOCK_RETRIES retries
+        self.assertEqual(lock.call_count, 4)
+        self.assertEqual(len(logs.records), 3)
+
+        errors = [OperationalError("database is locked")] * 4
+        with mock.patch("menu_maker.models._lock_trees", side_effect=errors):
+            node = MenuItem(name="New Item", lft=0, rgt=0)
+            with self.assertLogs("menu_maker.models", "WARNING") as logs:
+                self.assertRaises(OperationalError, node.save)
+        # only failure of last attempt is logged as error
+        self.assertEqual(
+            [record.levelname for record in logs.records], ["WARNING"] * 3 + ["ERROR"]
+        )
+        self.assertEqual(
+            logs.records[-1].getMessage(), "Error when creating new root node"
+        )
+
+        with mock.patch("menu_maker.models._lock_trees", side_effect=errors) as lock:
+            with self.assertRaises(OperationalError):
+                with transaction.atomic():
+                    MenuItem.objects.rebalance()
+        # outer transaction is not repeated
+        self.assertEqual(lock.call_count, 1)
+
+        errors = [OperationalError("no such table"), None]
+        with mock.patch("menu_maker.models._lock_trees", side_effect=errors) as lock:
+            self.assertRaises(OperationalError, MenuItem.objects.rebalance)
+        self.assertEqual(lock.call_count, 1)
@@ -0,0 +1,208 @@
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from menu_maker import cache as menu_cache, snapshot
+from menu_maker.cache import TreeRow
+from menu_maker.models import MenuItem
+from menu_maker.snapshot import Snapshot, get_snapshot, write_snapshot
+
+
+class TestSnapshotWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "menu.snapshot")
+        snapshot._snapshot = None
+        self.addCleanup(setattr, snapshot, "_snapshot", None)
+        MenuItem(name="Electronics").save()
+
+    def test_get_tree(self):
+        write_snapshot(self.path, 1)
+        tree_snapshot = Snapshot(self.path)
+
+        self.assertEqual(tree_snapshot.version, 1)
+        self.assertEqual(len(tree_snapshot), 12)
+        for root in ("Clothing", "womens", "Electronics"):
+            self.assertEqual(
+                tree_snapshot.get_tree(root),
+                MenuItem.objects.get_cached_tree(root),
+            )
+        self.assertEqual(
+            tree_snapshot.get_tree("Dresses"),
+            (
+                TreeRow(7, "Dresses", "dresses", 11, 16, 3),
+                TreeRow(10, "Evening Gowns", "evening-gowns", 12, 13, 7),
+                TreeRow(11, "Sun Dresses", "sun-dresses", 14, 15, 7),
+            ),
+        )
+        self.assertIsNone(tree_snapshot.get_tree("Shoes"))
+
+    def test_get_children(self):
+        write_snapshot(self.path, 1)
+        tree_snapshot = Snapshot(self.path)
+
+        children = tree_snapshot.get_children(3)
+
+        self.assertEqual(
+            [(row.name, has_children) for row, has_children in children],
+            [("Dresses", True), ("Skirts", False), ("Blouses", False)],
+        )
+        self.assertEqual(tree_snapshot.get_children(12), [])
+        self.assertIsNone(tree_snapshot.get_children(100))
+
+    def test_replaced_file(self):
+        write_snapshot(self.path, 1)
+        old_snapshot = Snapshot(self.path)
+        MenuItem.objects.filter(name="Skirts").update(name="Pants")
+
+        write_snapshot(self.path, 2)
+
+        # mapping of replaced file stays readable
+        self.assertEqual(old_snapshot.get_tree("Women's")[4].name, "Skirts")
+        self.assertEqual(Snapshot(self.path).get_tree("Women's")[4].name, "Pants")
+
+    def test_invalid_file(self):
+        with open(self.path, "wb") as file:
+            file.write(b"not a snapshot")
+
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+        with override_settings(MENU_MAKER_SNAPSHOT_PATH=self.path):
+            with mock.patch("menu_maker.snapshot.Snapshot", wraps=Snapshot) as opened:
+                self.assertIsNone(get_snapshot(1))
+                self.assertIsNone(get_snapshot(1))
+            # invalid file is not read again until it is replaced
+            self.assertEqual(opened.call_count, 1)
+
+            write_snapshot(self.path, 1)
+            self.assertEqual(get_snapshot(1).version, 1)
+
+    def test_write_newer_version_kept(self):
+        write_snapshot(self.path, 2)
+
+        self.assertFalse(write_snapshot(self.path, 1))
+        self.assertEqual(Snapshot(self.path).version, 2)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["menu.snapshot"])
+        # workers may run as other user
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+    def test_get_snapshot(self):
+        self.assertIsNone(get_snapshot(1))
+
+        with override_settings(MENU_MAKER_SNAPSHOT_PATH=self.path):
+            # missing snapshot is not written by readers
+            with self.assertNumQueries(0):
+                self.assertIsNone(get_snapshot(1))
+            self.assertFalse(os.path.exists(self.path))
+
+            write_snapshot(self.path, 1)
+            tree_snapshot = get_snapshot(1)
+            self.assertEqual(tree_snapshot.version, 1)
+            self.assertIs(get_snapshot(1), tree_snapshot)
+
+            # outdated file is not mapped again until it is replaced
+            with mock.patch("menu_maker.snapshot.Snapshot") as opened:
+                self.assertIsNone(get_snapshot(2))
+            opened.assert_not_called()
+
+            # other process has written newer version
+            write_snapshot(self.path, 2)
+            self.assertEqual(get_snapshot(2).version, 2)
+            self.assertIsNone(get_snapshot(1))
+
+    def test_draw_menus_from_snapshot(self):
+        expected = MenuItem.objects.get_cached_trees(["Clothing", "Electronics"])
+        cache.clear()
+
+        with override_settings(MENU_MAKER_SNAPSHOT_PATH=self.path):
+            out = StringIO()
+            call_command("write_snapshot", stdout=out)
+            self.assertIn("Written snapshot", out.getvalue())
+
+            # only tree version is read, rows are not cached by this process
+            with self.assertNumQueries(1):
+                trees = MenuItem.objects.get_cached_trees(["Clothing", "Electronics"])
+            self.assertEqual(trees, expected)
+            version = menu_cache.get_tree_version()
+            self.assertIsNone(
+                cache.get(menu_cache.cache_key("tree", "Clothing", version))
+            )
+
+            node = MenuItem.objects.get(name="Skirts")
+            node.name = "Pants"
+            # snapshot is written in background after commit
+            with self.captureOnCommitCallbacks() as callbacks:
+                node.save()
+            self.assertEqual(callbacks, [snapshot._request_update])
+            self.assertTrue(snapshot.update_snapshot())
+            tree_snapshot = get_snapshot(menu_cache.get_tree_version())
+            self.assertIn(
+                "Pants", [row.name for row in tree_snapshot.get_tree("Clothing")]
+            )
+            self.assertEqual(
+                MenuItem.objects.get_cached_tree("Clothing"),
+                tree_snapshot.get_tree("Clothing"),
+            )
+
+            response = self.client.get(reverse("menu_maker:children", args=[3]))
+            self.assertEqual(
+                [child["has_children"] for child in response.json()["children"]],
+                [True, False, False],
+            )
+            response = self.client.get(reverse("menu_maker:children", args=[100]))
+            self.assertEqual(response.status_code, 404)
+
+            out = StringIO()
+            call_command("write_snapshot", stdout=out)
+            self.assertIn("up to date", out.getvalue())
+
+    def test_outdated_snapshot(self):
+        with override_settings(MENU_MAKER_SNAPSHOT_PATH=self.path):
+            write_snapshot(self.path, menu_cache.get_tree_version())
+            node = MenuItem.objects.get(name="Skirts")
+            node.name = "Pants"
+            node.save()
+
+            # snapshot is not written until commit, trees are read from database
+            with self.assertNumQueries(3):
+                tree = MenuItem.objects.get_cached_tree("Clothing")
+            self.assertIn("Pants", [row.name for row in tree])
+            outdated = Snapshot(self.path).get_tree("Clothing")
+            self.assertIn("Skirts", [row.name for row in outdated])
+
+    def test_write_snapshot_not_set(self):
+        with self.assertRaises(CommandError):
+            call_command("write_snapshot")
+
+
+class TestSnapshotWriter(TransactionTestCase):
+    fixtures = ["menu_maker.json"]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "menu.snapshot")
+        snapshot._snapshot = None
+        self.addCleanup(setattr, snapshot, "_snapshot", None)
+
+    def test_write_after_commit(self):
+        with override_settings(MENU_MAKER_SNAPSHOT_PATH=self.path):
+            node = MenuItem.objects.get(name="Skirts")
+            node.name = "Pants"
+            node.save()
+            # writer may have finished already
+            writer = snapshot._writer
+            if writer is not None:
+                writer.join()
+
+            tree_snapshot = get_snapshot(menu_cache.get_tree_version())
+        self.assertIsNone(snapshot._writer)
+        self.assertIn("Pants", [row.name for row in tree_snapshot.get_tree("Clothing")])
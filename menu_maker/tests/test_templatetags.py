@@ -0,0 +1,217 @@
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase
+from django.urls import resolve
+from django.utils.html import escape
+from menu_maker.cache import TreeRow
+from menu_maker.models import MenuItem
+from menu_maker.middleware import menu_registry_middleware
+from menu_maker.templatetags.draw_menu import MenuRegistry, _annotate_nodes
+
+
+class TestAnnotateNodes(TestCase):
+    def test_annotate_nodes(self):
+        rows = [
+            TreeRow(1, "A", "a", 1, 10, None),
+            TreeRow(2, "B", "b", 2, 5, 1),
+            TreeRow(3, "C", "c", 3, 4, 2),
+            TreeRow(4, "D", "d", 6, 9, 1),
+            TreeRow(5, "E", "e", 7, 8, 4),
+        ]
+        nodes = _annotate_nodes(rows, "c")
+
+        self.assertEqual([node.depth for node in nodes], [0, 1, 2, 1, 2])
+        self.assertEqual([node.parent for node in nodes], [-1, 0, 1, 0, 3])
+        self.assertEqual(
+            [node.is_parent for node in nodes], [True, True, False, True, False]
+        )
+        self.assertEqual(
+            [node.is_last_child for node in nodes], [False, False, True, True, True]
+        )
+        self.assertEqual([node.close_count for node in nodes], [0, 0, 1, 0, 2])
+        self.assertEqual(
+            [node.is_active for node in nodes], [False, False, True, False, False]
+        )
+        self.assertEqual(
+            [node.hidden for node in nodes], [False, False, False, True, True]
+        )
+
+    def test_annotate_empty(self):
+        self.assertEqual(_annotate_nodes([], "a"), [])
+
+
+class TestDrawMenuWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def _render(self, template: str, path: str = "/clothing/dresses/") -> str:
+        request = self.factory.get(path)
+        request.resolver_match = resolve(path)
+        return Template("{% load draw_menu %}" + template).render(
+            Context({"request": request})
+        )
+
+    def test_draw_menu(self):
+        html = self._render("{% draw_menu 'Clothing' %}")
+
+        for item in MenuItem.objects.all():
+            self.assertIn(
+                f'<a href="/clothing/{item.slug}/">{escape(item.name)}</a>', html
+            )
+
+    def test_draw_menu_cached(self):
+        # tree version, top node and rows
+        with self.assertNumQueries(3):
+            self._render("{% draw_menu 'Clothing' %}")
+        # only tree version
+        with self.assertNumQueries(1):
+            self._render("{% draw_menu 'Clothing' %}")
+
+        node = MenuItem.objects.get(name="Skirts")
+        node.name = "Pants"
+        node.save()
+
+        html = self._render("{% draw_menu 'Clothing' %}")
+        self.assertIn(">Pants</a>", html)
+        self.assertNotIn(">Skirts</a>", html)
+
+    def test_draw_menu_active_path(self):
+        html = self._render("{% draw_menu 'Clothing' %}")
+
+        self.assertEqual(html.count('class="menu-item active"'), 1)
+        self.assertIn(
+            '<li class="menu-item active">\n        \n            <span>></span>'
+            '\n        \n            \n                <a href="/clothing/dresses/">',
+            html,
+        )
+        # clothing, women's and dresses are expanded, men's and suits are not
+        self.assertEqual(html.count('class="menu submenu"'), 3)
+        self.assertEqual(html.count('class="menu submenu submenu-hidden"'), 2)
+
+    def test_draw_menu_other_path_reuses_fragment(self):
+        self._render("{% draw_menu 'Clothing' %}")
+
+        with self.assertNumQueries(1):
+            html = self._render("{% draw_menu 'Clothing' %}", "/clothing/suits/")
+
+        self.assertEqual(html.count('class="menu-item active"'), 1)
+        self.assertIn('<li class="menu-item active">', html)
+        # clothing, men's and suits are expanded
+        self.assertEqual(html.count('class="menu submenu"'), 3)
+
+    def test_draw_menu_no_active(self):
+        html = self._render("{% draw_menu 'Clothing' %}", "/")
+
+        self.assertNotIn("active", html)
+        self.assertEqual(html.count('class="menu submenu submenu-hidden"'), 5)
+
+    def test_registry_shared_by_tags(self):
+        request = self.factory.get("/clothing/dresses/")
+        request.resolver_match = resolve("/clothing/dresses/")
+        template = Template(
+            "{% load draw_menu %}{% draw_menu 'Clothing' %}{% draw_menu 'Clothing' %}"
+            "{% menu_breadcrumbs as breadcrumbs %}"
+            "{% for item in breadcrumbs %}/{{ item.name }}{% endfor %}"
+        )
+        render = menu_registry_middleware(
+            lambda request: HttpResponse(template.render(Context({"request": request})))
+        )
+        # tree version is read once per request, tree rows for breadcrumbs
+        # come from cache filled by loading the menu
+        with self.assertNumQueries(3):
+            html = render(request).content.decode()
+
+        self.assertEqual(html.count('<ul class="menu-maker">'), 2)
+        self.assertTrue(html.endswith(escape("/Clothing/Women's/Dresses")))
+        self.assertEqual(request.menu_registry.active_item.id, 7)
+
+    def test_registry_middleware(self):
+        request = self.factory.get("/clothing/suits/")
+        menu_registry_middleware(lambda request: HttpResponse())(request)
+        # registry is created after url is resolved
+        request.resolver_match = resolve("/clothing/suits/")
+
+        self.assertEqual(request.menu_registry.active_slug, "suits")
+        self.assertIsNone(request.menu_registry.active_item)
+        self.assertEqual(request.menu_registry.get_breadcrumbs(), [])
+        request.menu_registry.load(["Clothing", "Clothing"])
+        self.assertEqual(
+            [row.name for row in request.menu_registry.get_breadcrumbs()],
+            ["Clothing", "Men's", "Suits"],
+        )
+
+    def test_registry_loads_active_tree_only(self):
+        MenuItem(name="Electronics").save()
+        self._render("{% load_menus 'Clothing' 'Electronics' %}")
+
+        request = self.factory.get("/")
+        request.resolver_match = resolve("/")
+        Template("{% load draw_menu %}{% draw_menu 'Clothing' %}").render(
+            Context({"request": request})
+        )
+        # drawing menus needs fragments only
+        self.assertEqual(request.menu_registry.trees, {})
+
+        registry = MenuRegistry("dresses")
+        registry.load(["Clothing", "Electronics"])
+        self.assertEqual(registry.trees, {})
+        self.assertEqual(registry.active_item.name, "Dresses")
+        self.assertEqual(list(registry.trees), ["Clothing"])
+
+    def test_load_menus(self):
+        root = MenuItem(name="Electronics", lft=0, rgt=0)
+        root.save()
+        MenuItem(name="Laptops", lft=0, rgt=0, parent=root).save()
+        template = (
+            "{% load_menus 'Clothing' 'Electronics' %}"
+            "{% draw_menu 'Clothing' %}{% draw_menu 'Electronics' %}"
+        )
+        with self.assertNumQueries(3):
+            html = self._render(template)
+
+        self.assertEqual(html.count('<ul class="menu-maker">'), 2)
+        self.assertIn('<a href="/electronics/laptops/">Laptops</a>', html)
+
+        with self.assertNumQueries(1):
+            self._render(template)
+
+        # list of names, e.g. menus of the view
+        html = Template(
+            "{% load draw_menu %}{% load_menus menus %}{% draw_menu 'Electronics' %}"
+        ).render(Context({"request": self.factory.get("/"), "menus": ["Electronics"]}))
+        self.assertIn('<a href="/electronics/laptops/">Laptops</a>', html)
+
+    def test_draw_menu_depth(self):
+        with self.assertNumQueries(3):
+            html = self._render("{% draw_menu 'Clothing' depth=1 %}")
+
+        drawn = ["Clothing", "Men's", "Women's", "Dresses", "Evening Gowns"]
+        drawn += ["Sun Dresses", "Skirts", "Blouses"]
+        for item in MenuItem.objects.all():
+            link = f'<a href="/clothing/{item.slug}/">{escape(item.name)}</a>'
+            if item.name in drawn:
+                self.assertIn(link, html)
+            else:
+                self.assertNotIn(link, html)
+        self.assertEqual(html.count('class="menu-item active"'), 1)
+        # men's is collapsed, its children are not drawn
+        self.assertEqual(html.count("<span>></span>"), 4)
+        self.assertEqual(html.count('class="menu submenu"'), 3)
+        self.assertEqual(html.count("<ul"), html.count("</ul>"))
+
+        with self.assertNumQueries(1):
+            self._render("{% draw_menu 'Clothing' depth=1 %}")
+
+    def test_draw_menu_depth_no_active(self):
+        html = self._render("{% draw_menu 'Clothing' depth=0 %}", "/")
+        self.assertIn('<a href="/clothing/clothing/">Clothing</a>', html)
+        self.assertEqual(html.count("<li"), 1)
+        self.assertEqual(html.count("<span>></span>"), 1)
+
+        html = self._render("{% draw_menu 'Clothing' depth=2 %}", "/")
+        self.assertEqual(html.count("<li"), 7)
+        self.assertNotIn("Slacks", html)
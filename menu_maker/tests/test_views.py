@@ -0,0 +1,133 @@
+import tempfile
+from django.core.cache import cache
+from django.db import transaction
+from django.test import Client, TestCase
+from django.urls import reverse
+from menu_maker import cache as menu_cache
+from menu_maker.models import MenuItem
+
+
+class TestChildrenViewWithFixtures(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.node = MenuItem.objects.get(name="Women's")
+        self.url = reverse("menu_maker:children", args=[self.node.id])
+
+    def test_children(self):
+        # tree version, item and its children
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "id": self.node.id,
+                "children": [
+                    {
+                        "id": item.id,
+                        "name": item.name,
+                        "slug": item.slug,
+                        "has_children": item.name == "Dresses",
+                    }
+                    for item in MenuItem.objects.filter(parent=self.node).order_by(
+                        "lft"
+                    )
+                ],
+            },
+        )
+        self.assertIn("public", response["Cache-Control"])
+        self.assertIn("max-age=60", response["Cache-Control"])
+        self.assertTrue(response.has_header("ETag"))
+        self.assertTrue(response.has_header("Last-Modified"))
+
+        # tree version is read once per request
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+
+    def test_children_not_modified(self):
+        etag = self.client.get(self.url)["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("max-age=60", response["Cache-Control"])
+
+        node = MenuItem.objects.get(name="Skirts")
+        node.name = "Pants"
+        node.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertContains(response, '"name":"Pants"')
+
+    def test_children_unknown(self):
+        response = self.client.get(reverse("menu_maker:children", args=[1000]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_children_head(self):
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header("ETag"))
+
+    def test_children_post(self):
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, 405)
+
+
+class TestChildrenViewWithSharedCache(TestCase):
+    fixtures = ["menu_maker.json"]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = self.settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": directory.name,
+                }
+            }
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.client = Client()
+        self.url = reverse("menu_maker:children", args=[3])
+
+    def test_children_not_modified(self):
+        # item and its children, tree version is kept in shared cache
+        with self.assertNumQueries(2):
+            etag = self.client.get(self.url)["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        node = MenuItem.objects.get(name="Skirts")
+        node.name = "Pants"
+        # shared version is bumped after commit
+        with self.captureOnCommitCallbacks(execute=True):
+            node.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '"name":"Pants"')
+
+    def test_uncommitted_change(self):
+        version = menu_cache.get_tree_version()
+
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            node = MenuItem.objects.get(name="Skirts")
+            node.name = "Pants"
+            node.save()
+            # uncommitted rows are not cached for other processes
+            self.assertLess(menu_cache.get_tree_version(), 0)
+            with self.assertNumQueries(2):
+                response = self.client.get(self.url)
+            self.assertContains(response, '"name":"Pants"')
+            self.assertEqual(menu_cache.get_many("children", ["3"], version), {})
+
+        self.assertGreater(menu_cache.get_tree_version(), version)
@@ -0,0 +1,133 @@
+"""Reading and writing menu trees in JSON, JSON Lines, CSV and YAML.
+
+Nested formats (json, yaml) hold a list of root items, where each item is a mapping
+with "name", optional "slug" and optional "children" list of items.
+Flat formats (jsonl, csv) hold one record per item with "id", "parent", "name"
+and "slug" fields, where "parent" is "id" of another record or empty for roots.
+Children keep the order of records. Yaml is read only.
+"""
+import csv
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, TextIO
+
+FORMATS = ("json", "jsonl", "csv", "yaml")
+WRITE_FORMATS = ("json", "jsonl", "csv")
+RECORD_FIELDS = ("id", "parent", "name", "slug")
+
+
+def guess_format(path: str) -> str:
+    suffix = Path(path).suffix.lstrip(".").lower()
+    if suffix == "yml":
+        return "yaml"
+    if suffix not in FORMATS:
+        raise ValueError(f"can not guess format of {path}, expected one of {FORMATS}")
+    return suffix
+
+
+def records_to_tree(records: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """converts flat records with id and parent references to nested items"""
+    nodes = {}
+    roots = []
+    for record in records:
+        node = {"name": record["name"], "slug": record.get("slug"), "children": []}
+        key = str(record["id"])
+        if key in nodes:
+            raise ValueError(f"duplicate record id {key}")
+        nodes[key] = (node, record.get("parent"))
+
+    for node, parent in nodes.values():
+        if parent in (None, ""):
+            roots.append(node)
+        elif str(parent) in nodes:
+            nodes[str(parent)][0]["children"].append(node)
+        else:
+            raise ValueError(f"unknown parent {parent} of {node['name']}")
+
+    _check_acyclic(roots, len(nodes))
+    return roots
+
+
+def _check_acyclic(roots: List[Dict[str, Any]], total: int):
+    reached = 0
+    stack = list(roots)
+    while stack:
+        reached += 1
+        stack.extend(stack.pop()["children"])
+    if reached != total:
+        raise ValueError("records contain parent reference cycle")
+
+
+def _check_items(items: Any) -> List[Dict[str, Any]]:
+    """checks that nested items are lists of mappings with name and optional
+    children list, so that invalid files are reported before loading"""
+    stack = [(items, "root items")]
+    while stack:
+        children, owner = stack.pop()
+        if not isinstance(children, list):
+            raise ValueError(f"{owner} must be a list of items")
+        for item in children:
+            if not isinstance(item, dict):
+                raise ValueError(f"item {item!r} of {owner} is not a mapping")
+            if not item.get("name"):
+                raise ValueError(f"item {item!r} of {owner} has no name")
+            if item.get("children") is not None:
+                stack.append((item["children"], f"children of {item['name']}"))
+    return items
+
+
+def read_tree(stream: TextIO, format: str) -> List[Dict[str, Any]]:
+    """reads nested items from stream in given format"""
+    if format == "json":
+        return _check_items(json.load(stream))
+    if format == "jsonl":
+        return records_to_tree(json.loads(line) for line in stream if line.strip())
+    if format == "csv":
+        return records_to_tree(csv.DictReader(stream))
+    if format == "yaml":
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("PyYAML has to be installed to read yaml format")
+        return _check_items(yaml.safe_load(stream) or [])
+    raise ValueError(f"unknown format {format}, expected one of {FORMATS}")
+
+
+def write_tree(records: Iterable[Dict[str, Any]], stream: TextIO, format: str):
+    """writes flat records ordered by lft to stream in given format,
+    holding only current ancestors in memory"""
+    if format == "jsonl":
+        for record in records:
+            stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+    elif format == "csv":
+        writer = csv.DictWriter(stream, RECORD_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    elif format == "json":
+        _write_nested_json(records, stream)
+    else:
+        raise ValueError(f"unknown format {format}, expected one of {WRITE_FORMATS}")
+
+
+def _write_nested_json(records: Iterable[Dict[str, Any]], stream: TextIO):
+    # ids of items with open children list
+    stack = []
+    started = False
+    stream.write("[")
+    for record in records:
+        # unless record is first child of previous one, close previous items
+        # up to record parent and separate record from its previous sibling
+        if not stack or stack[-1] != record["parent"]:
+            while stack and stack[-1] != record["parent"]:
+                stack.pop()
+                stream.write("]}")
+            if started:
+                stream.write(", ")
+        started = True
+
+        name = json.dumps(record["name"], ensure_ascii=False)
+        slug = json.dumps(record["slug"], ensure_ascii=False)
+        stream.write(f'{{"name": {name}, "slug": {slug}, "children": [')
+        stack.append(record["id"])
+    stream.write("]}" * len(stack))
+    stream.write("]\n")
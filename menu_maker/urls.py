@@ -0,0 +1,8 @@
+from django.urls import path
+from . import views
+
+app_name = "menu_maker"
+
+urlpatterns = [
+    path("<int:id>/children/", views.children, name="children"),
+]
@@ -1,3 +1,58 @@
-from django.shortcuts import render
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+from django.db.models import Exists, OuterRef
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_safe
+from menu_maker import cache, conf, snapshot
+from menu_maker.models import MenuItem
 
-# Create your views here.
+
+def _children_etag(request: HttpRequest, id: int) -> str:
+    # any tree change may add, remove or reorder children of any item
+    return f"{cache.get_tree_version()}-{id}"
+
+
+def _children_last_modified(request: HttpRequest, id: int) -> datetime:
+    return datetime.fromtimestamp(cache.get_tree_modified(), timezone.utc)
+
+
+def _get_children(id: int) -> List[Dict[str, Any]]:
+    version = cache.get_tree_version()
+    tree_snapshot = snapshot.get_snapshot(version)
+    if tree_snapshot is not None:
+        rows = tree_snapshot.get_children(id)
+        if rows is None:
+            raise Http404("No MenuItem matches the given query.")
+        return [
+            {"id": row.id, "name": row.name, "slug": row.slug, "has_children": flag}
+            for row, flag in rows
+        ]
+
+    children = cache.get_many("children", [str(id)], version).get(str(id))
+    if children is None:
+        items = MenuItem.objects.get_descendants(id, direct_only=True).annotate(
+            has_children=Exists(MenuItem.objects.filter(parent=OuterRef("pk")))
+        )
+        children = list(items.values("id", "name", "slug", "has_children"))
+        cache.set_many("children", {str(id): children}, version)
+    return children
+
+
+@condition(etag_func=_children_etag, last_modified_func=_children_last_modified)
+def _children(request: HttpRequest, id: int) -> HttpResponse:
+    return JsonResponse(
+        {"id": id, "children": _get_children(id)},
+        json_dumps_params={"separators": (",", ":"), "ensure_ascii": False},
+    )
+
+
+@require_safe
+def children(request: HttpRequest, id: int) -> HttpResponse:
+    """returns direct children of menu item as json, so that collapsed menu
+    branches can be loaded on expansion. Responses are validated by tree
+    version, so conditional requests are answered by 304 from a shared cache
+    alone, or after reading the version from database with process-local one"""
+    response = _children(request, id)
+    patch_cache_control(response, public=True, max_age=conf.get("CHILDREN_MAX_AGE"))
+    return response
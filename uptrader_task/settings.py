@@ -49,6 +49,8 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "menu_maker.middleware.server_timing_middleware",
+    "menu_maker.middleware.menu_registry_middleware",
 ]
 
 ROOT_URLCONF = "uptrader_task.urls"
@@ -18,5 +18,6 @@ from django.urls import path, include
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("menu/", include("menu_maker.urls")),
     path("", include("website.urls")),
 ]
@@ -1,29 +1,31 @@
 from typing import Any
 from django.core.management.base import BaseCommand
 from menu_maker.models import MenuItem
+from menu_maker.tree_io import records_to_tree
 
+# name and 1-based row of parent
 menu_data = [
-    ["Clothing", 1, 22],
-    ["Men's", 2, 9, 1],
-    ["Women's", 10, 21, 1],
-    ["Suits", 3, 8, 2],
-    ["Slacks", 4, 5, 4],
-    ["Jackets", 6, 7, 4],
-    ["Dresses", 11, 16, 3],
-    ["Skirts", 17, 18, 3],
-    ["Blouses", 19, 20, 3],
-    ["Evening Gowns", 12, 13, 7],
-    ["Sun Dresses", 14, 15, 7],
-    ["Electronics", 23, 42],
-    ["Home", 24, 29, 12],
-    ["Computers", 30, 35, 12],
-    ["Portable", 36, 41, 12],
-    ["Freezers", 25, 26, 13],
-    ["Microwaves", 27, 28, 13],
-    ["PC", 31, 32, 14],
-    ["Laptops", 33, 34, 14],
-    ["Smartphones", 37, 38, 15],
-    ["Smartwatches", 39, 40, 15],
+    ["Clothing"],
+    ["Men's", 1],
+    ["Women's", 1],
+    ["Suits", 2],
+    ["Slacks", 4],
+    ["Jackets", 4],
+    ["Dresses", 3],
+    ["Skirts", 3],
+    ["Blouses", 3],
+    ["Evening Gowns", 7],
+    ["Sun Dresses", 7],
+    ["Electronics"],
+    ["Home", 12],
+    ["Computers", 12],
+    ["Portable", 12],
+    ["Freezers", 13],
+    ["Microwaves", 13],
+    ["PC", 14],
+    ["Laptops", 14],
+    ["Smartphones", 15],
+    ["Smartwatches", 15],
 ]
 
 
@@ -31,16 +33,18 @@ class Command(BaseCommand):
     help = "Load sample menu tree"
 
     def handle(self, *args: Any, **options: Any) -> None:
-        for item in menu_data:
-            if len(item) > 3:
-                parent = MenuItem.objects.get(id=item[3])
-            else:
-                parent = None
+        records = [
+            {"id": i, "name": item[0], "parent": item[1] if len(item) > 1 else None}
+            for i, item in enumerate(menu_data, start=1)
+        ]
+        existing = set(
+            MenuItem.objects.filter(parent=None).values_list("name", flat=True)
+        )
+        tree = [
+            root for root in records_to_tree(records) if root["name"] not in existing
+        ]
+        created = {item.name for item in MenuItem.objects.bulk_load_tree(tree)}
 
-            item, created = MenuItem.objects.get_or_create(
-                name=item[0],
-                defaults={"lft": item[1], "rgt": item[2], "parent": parent},
-            )
-
-            if created:
-                print(f"Created menu item for {item.name}")
+        for record in records:
+            if record["name"] in created:
+                print(f"Created menu item for {record['name']}")
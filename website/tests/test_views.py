@@ -1,5 +1,11 @@
-from django.test import TestCase, Client
+import tempfile
+from io import StringIO
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import AsyncClient, TestCase, Client
 from django.urls import reverse
+from menu_maker.cache import TreeRow
+from menu_maker.models import MenuItem
 
 
 class TestHomeView(TestCase):
@@ -10,3 +16,95 @@ class TestHomeView(TestCase):
         url = reverse("home")
         response = self.client.get(url)
         self.assertTrue(response.status_code, 200)
+
+
+class TestHomeViewWithSample(TestCase):
+    def setUp(self):
+        cache.clear()
+        call_command("load_sample", stdout=StringIO())
+        self.client = Client()
+
+    def test_menus_query_count(self):
+        url = reverse("clothing", args=["dresses"])
+        # tree version, roots and subtrees of both menus, active item is found
+        # among their rows
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<ul class="menu-maker">', count=2)
+
+        # only tree version
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("electronics", args=["laptops"]))
+        self.assertContains(response, "Current menu: Laptops")
+
+    def test_breadcrumbs(self):
+        response = self.client.get(reverse("clothing", args=["dresses"]))
+
+        self.assertContains(
+            response,
+            '<a href="/clothing/clothing/">Clothing</a> /'
+            '\n            \n                <a href="/clothing/womens/">',
+        )
+        self.assertContains(response, '<a href="/clothing/dresses/">Dresses</a>\n')
+
+    def test_active_item_outside_of_menus(self):
+        root = MenuItem(name="Shoes")
+        root.save()
+        MenuItem(name="Boots", parent=root).save()
+
+        # tree version, menus, then active item
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("clothing", args=["boots"]))
+
+        self.assertContains(response, "Current menu: Boots")
+        self.assertNotContains(response, "breadcrumbs")
+        # same type as active item found in menus
+        self.assertEqual(
+            response.context["menu_item"],
+            MenuItem.objects.filter(name="Boots").values_list(*TreeRow._fields)[0],
+        )
+        self.assertIsInstance(response.context["menu_item"], TreeRow)
+
+    async def test_async_home_view(self):
+        client = AsyncClient()
+        response = await client.get(reverse("clothing", args=["dresses"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Current menu: Dresses")
+        self.assertContains(response, '<ul class="menu-maker">', count=2)
+
+        response = await client.get(reverse("clothing", args=["unknown"]))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestHomeViewWithSharedCache(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = self.settings(
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": directory.name,
+                }
+            }
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # shared tree version is bumped after commit
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("load_sample", stdout=StringIO())
+        self.client = Client()
+
+    def test_menus_query_count(self):
+        url = reverse("clothing", args=["dresses"])
+        # roots and subtrees of both menus
+        with self.assertNumQueries(2):
+            self.client.get(url)
+
+        # tree version is kept in shared cache
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, '<ul class="menu-maker">', count=2)
+        self.assertContains(response, "Current menu: Dresses")
@@ -1,14 +1,38 @@
+from typing import Optional
+from django.http import Http404
 from django.views.generic.base import TemplateView
-from django.shortcuts import get_object_or_404
+from menu_maker.cache import TreeRow
 from menu_maker.models import MenuItem
+from menu_maker.templatetags.draw_menu import MenuRegistry, get_registry
 
 
 class HomeView(TemplateView):
     template_name = "website/home.html"
+    # menus drawn by template, loaded before rendering
+    menus = ["Clothing", "Electronics"]
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    async def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+        registry = get_registry(request)
+        await registry.aload(self.menus)
+        menu_item = await self.aget_menu_item(registry)
+        if menu_item:
+            context["menu_item"] = menu_item
+        return self.render_to_response(context)
+
+    async def aget_menu_item(self, registry: MenuRegistry) -> Optional[TreeRow]:
         menu_key = self.kwargs.get("slug")
-        if menu_key:
-            context["menu_item"] = get_object_or_404(MenuItem, slug=menu_key)
-        return context
+        if not menu_key:
+            return None
+        # active item is usually among rows of loaded menus
+        item = await registry.aget_active_item()
+        if item is None:
+            values = (
+                await MenuItem.objects.filter(slug=menu_key)
+                .values_list(*TreeRow._fields)
+                .afirst()
+            )
+            item = TreeRow(*values) if values else None
+        if item is None:
+            raise Http404("No MenuItem matches the given query.")
+        return item